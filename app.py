@@ -1,33 +1,300 @@
-from flask import Flask, request, jsonify, send_file, render_template, Response
+from flask import Flask, g, request, jsonify, send_file, render_template, redirect, Response
+import contextlib
+import hashlib
 import os
 import re
 from datetime import datetime
-import traceback
+import uuid
 import time
-from urllib.parse import urlparse, parse_qs
+import unicodedata
+from urllib.parse import quote, urlencode, urlparse, parse_qs
 import logging
-import sys
 import yt_dlp
 import json
-import requests
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('app.log')
-    ]
+from itsdangerous import BadSignature, URLSafeSerializer
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import dump_options_header, parse_range_header
+from werkzeug.security import safe_join
+from cache import MetadataCache
+from transport import UpstreamTransport
+from segmented import SegmentedFetcher, parse_content_range
+from content_cache import ContentCache
+from formats import VIDEO_CODECS, FormatIndex, FormatSpecError, Preference, codec_family, parse_preference
+from thumbnails import ThumbnailCache
+from transcode import AUDIO_FORMATS, FFmpegPipeline, TranscodeBusy
+from jobs import FINISHED_STATES, JobManager, JobQueueFull
+from limits import AdmissionLimiter, Overloaded, UpstreamBackoff
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsRegistry, StreamMeter
+from logging_config import bind_log_context, clear_log_context, setup_logging
+
+# Configure logging. Records are queued and written by a background
+# thread; app.log holds JSON lines and is rotated by size, or by time when
+# LOG_ROTATE_WHEN is set (e.g. 'midnight'). Several gunicorn workers
+# rotating one file would lose each other's records, so with more than one
+# worker the file is off by default and, if LOG_FILE is set, only appended
+# to; rotation is then left to logrotate or the process manager.
+LOG_MULTI_PROCESS = int(os.environ.get('WEB_WORKERS', 1)) > 1
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.environ.get('LOG_FILE', '' if LOG_MULTI_PROCESS else 'app.log') or None
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+LOG_ROTATE_WHEN = os.environ.get('LOG_ROTATE_WHEN') or None
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_JSON_STDOUT = os.environ.get('LOG_JSON_STDOUT', 'False').lower() in ('1', 'true', 'yes')
+# Warnings and errors beyond this many per call site per interval are dropped
+LOG_ERROR_BURST = int(os.environ.get('LOG_ERROR_BURST', 10))
+LOG_ERROR_INTERVAL = float(os.environ.get('LOG_ERROR_INTERVAL', 60))
+
+log_pipeline = setup_logging(
+    level=LOG_LEVEL,
+    log_file=LOG_FILE,
+    max_bytes=LOG_MAX_BYTES,
+    backup_count=LOG_BACKUP_COUNT,
+    rotate_when=LOG_ROTATE_WHEN,
+    rotate=not LOG_MULTI_PROCESS,
+    queue_size=LOG_QUEUE_SIZE,
+    error_burst=LOG_ERROR_BURST,
+    error_interval=LOG_ERROR_INTERVAL,
+    json_stdout=LOG_JSON_STDOUT
 )
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or os.urandom(32).hex()
+handle_serializer = URLSafeSerializer(app.config['SECRET_KEY'], salt='download-handle')
 
 # Create download folder if it doesn't exist
-DOWNLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads')
+DOWNLOAD_FOLDER = os.environ.get('DOWNLOAD_FOLDER') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads')
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
 
+# Completed downloads are kept in DOWNLOAD_FOLDER up to this many bytes
+CONTENT_CACHE_MAX_BYTES = int(os.environ.get('CONTENT_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+CONTENT_CACHE_SWEEP_INTERVAL = int(os.environ.get('CONTENT_CACHE_SWEEP_INTERVAL', 60))
+
+content_cache = ContentCache(
+    DOWNLOAD_FOLDER,
+    max_bytes=CONTENT_CACHE_MAX_BYTES,
+    sweep_interval=CONTENT_CACHE_SWEEP_INTERVAL
+)
+content_cache.start_sweeper()
+
+# Background jobs for batch and playlist downloads
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_PER_JOB_CONCURRENCY = int(os.environ.get('JOB_PER_JOB_CONCURRENCY', 2))
+JOB_MAX_PENDING = int(os.environ.get('JOB_MAX_PENDING', 100))
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 3600))
+JOB_MAX_DEFERRALS = int(os.environ.get('JOB_MAX_DEFERRALS', 10))
+MAX_JOB_ITEMS = int(os.environ.get('MAX_JOB_ITEMS', 50))
+JOB_PROGRESS_INTERVAL = 0.25
+JOB_EVENT_KEEPALIVE = 15
+
+# Metadata cache settings. Entries live until shortly before the signed
+# format URLs expire, capped at METADATA_CACHE_MAX_TTL seconds.
+METADATA_CACHE_SIZE = int(os.environ.get('METADATA_CACHE_SIZE', 512))
+METADATA_CACHE_MAX_TTL = int(os.environ.get('METADATA_CACHE_MAX_TTL', 3600))
+SIGNED_URL_EXPIRY_MARGIN = 120
+
+# Lifetime of the handle /preview returns for reuse by /download. The
+# handle itself carries these fields of each direct format, so it stays
+# usable after a cache eviction or on another worker.
+DOWNLOAD_HANDLE_TTL = int(os.environ.get('DOWNLOAD_HANDLE_TTL', 1800))
+HANDLE_FORMAT_FIELDS = (
+    'format_id', 'ext', 'protocol', 'url', 'http_headers', 'vcodec', 'acodec', 'height', 'width', 'fps',
+    'tbr', 'vbr', 'abr', 'filesize', 'filesize_approx',
+)
+
+# Only these fields of an extraction are kept in the metadata cache. The
+# rest (caption and automatic-caption tables, thumbnail lists, fragment
+# lists) can be many times larger and is never read.
+METADATA_INFO_FIELDS = ('id', 'title', 'uploader', 'thumbnail', 'duration', 'view_count')
+METADATA_FORMAT_FIELDS = HANDLE_FORMAT_FIELDS + ('resolution', 'format_note')
+
+metadata_cache = MetadataCache(max_entries=METADATA_CACHE_SIZE, default_ttl=METADATA_CACHE_MAX_TTL)
+
+# Admission control. yt-dlp extractions and upstream streams each get a
+# bounded number of slots and a short wait queue; anything beyond that is
+# answered at once with 503 and Retry-After. Throttling by YouTube shrinks
+# both limits together and pauses new work for a growing cooldown.
+EXTRACT_CONCURRENCY = int(os.environ.get('EXTRACT_CONCURRENCY', 4))
+EXTRACT_QUEUE_SIZE = int(os.environ.get('EXTRACT_QUEUE_SIZE', 32))
+EXTRACT_QUEUE_TIMEOUT = float(os.environ.get('EXTRACT_QUEUE_TIMEOUT', 15))
+STREAM_CONCURRENCY = int(os.environ.get('STREAM_CONCURRENCY', 48))
+STREAM_QUEUE_SIZE = int(os.environ.get('STREAM_QUEUE_SIZE', 32))
+STREAM_QUEUE_TIMEOUT = float(os.environ.get('STREAM_QUEUE_TIMEOUT', 5))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 5))
+BACKOFF_BASE_DELAY = float(os.environ.get('BACKOFF_BASE_DELAY', 5))
+BACKOFF_MAX_DELAY = float(os.environ.get('BACKOFF_MAX_DELAY', 300))
+BACKOFF_RECOVERY_INTERVAL = float(os.environ.get('BACKOFF_RECOVERY_INTERVAL', 30))
+
+# Extraction errors that mean YouTube is rate limiting us
+THROTTLE_MARKERS = ('HTTP Error 429', 'Too Many Requests', 'not a bot')
+
+upstream_backoff = UpstreamBackoff(
+    base_delay=BACKOFF_BASE_DELAY,
+    max_delay=BACKOFF_MAX_DELAY,
+    recovery_interval=BACKOFF_RECOVERY_INTERVAL
+)
+extraction_limiter = AdmissionLimiter(
+    'extraction',
+    EXTRACT_CONCURRENCY,
+    max_queue=EXTRACT_QUEUE_SIZE,
+    queue_timeout=EXTRACT_QUEUE_TIMEOUT,
+    retry_after=ADMISSION_RETRY_AFTER,
+    backoff=upstream_backoff
+)
+stream_limiter = AdmissionLimiter(
+    'download',
+    STREAM_CONCURRENCY,
+    max_queue=STREAM_QUEUE_SIZE,
+    queue_timeout=STREAM_QUEUE_TIMEOUT,
+    retry_after=ADMISSION_RETRY_AFTER,
+    backoff=upstream_backoff
+)
+
+# Prometheus metrics served at /metrics. Stream histograms are labelled by
+# kind: direct, audio, mux or follow (reading a fill another request is
+# writing); requests by endpoint and outcome.
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 for n in range(6, 18))  # 64 KiB/s to 128 MiB/s
+
+metrics_registry = MetricsRegistry()
+requests_total = metrics_registry.counter(
+    'byteloader_requests_total', 'Preview and download requests by outcome', ('endpoint', 'outcome'))
+extract_seconds = metrics_registry.histogram(
+    'byteloader_extract_seconds', 'Time spent in yt-dlp extract_info, excluding queueing')
+upstream_ttfb_seconds = metrics_registry.histogram(
+    'byteloader_upstream_ttfb_seconds', 'Time from sending an upstream media request to its response headers')
+stream_seconds = metrics_registry.histogram(
+    'byteloader_stream_seconds', 'Duration of streamed download bodies', ('kind',))
+stream_stage_seconds = metrics_registry.histogram(
+    'byteloader_stream_stage_seconds',
+    'Per-stream time spent waiting on upstream versus waiting for the client to accept data',
+    ('kind', 'stage'))
+stream_bytes_per_second = metrics_registry.histogram(
+    'byteloader_stream_bytes_per_second', 'Average throughput of each streamed download', ('kind',),
+    buckets=THROUGHPUT_BUCKETS)
+stream_bytes_total = metrics_registry.counter(
+    'byteloader_stream_bytes_total', 'Bytes sent to clients by streamed downloads', ('kind',))
+metrics_registry.gauge(
+    'byteloader_active_streams', 'Downloads currently streaming from YouTube',
+    lambda: stream_limiter.stats()['active'])
+metrics_registry.gauge(
+    'byteloader_active_extractions', 'yt-dlp extractions currently running',
+    lambda: extraction_limiter.stats()['active'])
+metrics_registry.gauge(
+    'byteloader_queue_depth', 'Requests or job items waiting for a slot', lambda: {
+        ('extraction',): extraction_limiter.stats()['queued'],
+        ('streams',): stream_limiter.stats()['queued'],
+        ('ffmpeg',): ffmpeg_pipeline.stats()['queued'],
+        ('jobs',): job_manager.stats()['queued_items'],
+    }, ('queue',))
+metrics_registry.gauge(
+    'byteloader_upstream_capacity_ratio', 'Fraction of normal capacity allowed by the upstream backoff',
+    upstream_backoff.scale)
+
+# Pooled upstream transport used for all media byte fetches
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 32))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 5))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 30))
+UPSTREAM_MAX_CHUNK_SIZE = int(os.environ.get('UPSTREAM_MAX_CHUNK_SIZE', 1024 * 1024))
+# Connection pools are kept for this many of the most recently used hosts
+UPSTREAM_MAX_HOSTS = int(os.environ.get('UPSTREAM_MAX_HOSTS', 16))
+
+upstream_transport = UpstreamTransport(
+    pool_size=UPSTREAM_POOL_SIZE,
+    connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+    read_timeout=UPSTREAM_READ_TIMEOUT,
+    max_chunk_size=UPSTREAM_MAX_CHUNK_SIZE,
+    max_hosts=UPSTREAM_MAX_HOSTS,
+    on_throttle=lambda host: upstream_backoff.throttled(f"HTTP 429 from {host}")
+)
+
+# Large files are fetched as concurrent byte ranges. Set SEGMENT_CONCURRENCY
+# to 1 to always stream over a single connection.
+SEGMENT_CONCURRENCY = int(os.environ.get('SEGMENT_CONCURRENCY', 4))
+SEGMENT_SIZE = int(os.environ.get('SEGMENT_SIZE', 8 * 1024 * 1024))
+SEGMENT_BUFFER_SIZE = int(os.environ.get('SEGMENT_BUFFER_SIZE', 32 * 1024 * 1024))
+SEGMENTED_MIN_SIZE = int(os.environ.get('SEGMENTED_MIN_SIZE', 16 * 1024 * 1024))
+# Segments slower than this many bytes per second are requested again; 0 disables the check
+SEGMENT_MIN_THROUGHPUT = int(os.environ.get('SEGMENT_MIN_THROUGHPUT', 128 * 1024))
+
+# ffmpeg processes used for audio extraction and DASH video+audio muxing
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+FFMPEG_MAX_WORKERS = int(os.environ.get('FFMPEG_MAX_WORKERS', 4))
+FFMPEG_QUEUE_TIMEOUT = float(os.environ.get('FFMPEG_QUEUE_TIMEOUT', 10))
+FFMPEG_QUEUE_SIZE = int(os.environ.get('FFMPEG_QUEUE_SIZE', 16))
+AUDIO_BITRATE_KBPS = 192
+
+ffmpeg_pipeline = FFmpegPipeline(
+    max_workers=FFMPEG_MAX_WORKERS,
+    queue_timeout=FFMPEG_QUEUE_TIMEOUT,
+    ffmpeg_cmd=FFMPEG_BINARY,
+    max_queue=FFMPEG_QUEUE_SIZE,
+    # Muxes fetch the DASH URLs inside ffmpeg, out of the transport's sight
+    on_throttle=lambda message: upstream_backoff.throttled(f"ffmpeg: {message}")
+)
+
+# Content types for formats that are proxied without transcoding
+MEDIA_TYPES = {
+    'mp4': 'video/mp4',
+    'webm': 'video/webm',
+    '3gp': 'video/3gpp',
+    'm4a': 'audio/mp4',
+}
+
+segmented_fetcher = SegmentedFetcher(
+    upstream_transport,
+    segment_size=SEGMENT_SIZE,
+    concurrency=SEGMENT_CONCURRENCY,
+    max_buffer_bytes=SEGMENT_BUFFER_SIZE,
+    min_throughput=SEGMENT_MIN_THROUGHPUT
+)
+
+# Thumbnails are proxied through /thumb/<video_id>, shrunk to the width the
+# page displays them at (when Pillow is installed) and cached in memory and
+# in THUMBNAIL_FOLDER.
+THUMBNAIL_FOLDER = os.environ.get('THUMBNAIL_FOLDER') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thumbnails')
+THUMBNAIL_WIDTH = int(os.environ.get('THUMBNAIL_WIDTH', 480))
+THUMBNAIL_MAX_AGE = int(os.environ.get('THUMBNAIL_MAX_AGE', 7 * 24 * 3600))
+THUMBNAIL_MEMORY_ENTRIES = int(os.environ.get('THUMBNAIL_MEMORY_ENTRIES', 256))
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+THUMBNAIL_FALLBACK_URL = 'https://i.ytimg.com/vi/{video_id}/hqdefault.jpg'
+
+# Thumbnails come from i.ytimg.com, not the media hosts, so they get their
+# own transport: a 429 there must not trip the backoff that halves stream
+# capacity for every download.
+thumbnail_transport = UpstreamTransport(
+    pool_size=UPSTREAM_POOL_SIZE,
+    connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+    read_timeout=UPSTREAM_READ_TIMEOUT
+)
+
+thumbnail_cache = ThumbnailCache(
+    THUMBNAIL_FOLDER,
+    thumbnail_transport,
+    width=THUMBNAIL_WIDTH,
+    max_age=THUMBNAIL_MAX_AGE,
+    memory_entries=THUMBNAIL_MEMORY_ENTRIES,
+    max_bytes=THUMBNAIL_CACHE_MAX_BYTES
+)
+
+# Static asset URLs carry a hash of the file's contents (?v=...), so a
+# versioned URL never changes meaning and can be cached for a year.
+STATIC_MAX_AGE = 365 * 24 * 3600
+_static_versions = {}  # filename -> (mtime_ns, content hash)
+
+# What format_id 'best' means: the highest resolution that already carries
+# audio, so it streams without ffmpeg; and the best audio to extract from
+BEST_PREFERENCE = Preference(progressive=True, codecs=VIDEO_CODECS)
+BEST_AUDIO_PREFERENCE = Preference(audio_only=True)
+
+# Browser-like headers sent with yt-dlp's requests to YouTube
+YDL_HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-us,en;q=0.5',
+    'Sec-Fetch-Mode': 'navigate',
+}
+
 def clean_youtube_url(url):
     """Clean and standardize YouTube URL format."""
     try:
@@ -45,6 +312,14 @@ def clean_youtube_url(url):
         logger.error(f"Error cleaning URL: {str(e)}")
         return url
 
+def get_video_id(url):
+    """Return the canonical video ID for a URL, falling back to the cleaned URL."""
+    clean_url = clean_youtube_url(url)
+    query_params = parse_qs(urlparse(clean_url).query)
+    if 'v' in query_params:
+        return query_params['v'][0]
+    return clean_url
+
 def is_valid_youtube_url(url):
     """Validate YouTube URL format."""
     try:
@@ -54,6 +329,23 @@ def is_valid_youtube_url(url):
         logger.error(f"Error validating URL: {str(e)}")
         return False
 
+def parse_flag(value):
+    """Interpret a JSON boolean or a query-string flag such as 'true', '1' or 'yes'."""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+def is_playlist_url(url):
+    """Return True for YouTube playlist links (youtube.com/playlist?list=...)."""
+    try:
+        parsed_url = urlparse(url if '://' in url else f'https://{url}')
+        return ('youtube.com' in parsed_url.netloc
+                and parsed_url.path.rstrip('/') == '/playlist'
+                and 'list' in parse_qs(parsed_url.query))
+    except Exception as e:
+        logger.error(f"Error checking playlist URL: {str(e)}")
+        return False
+
 def sanitize_filename(filename):
     """Remove invalid characters from filename."""
     try:
@@ -64,126 +356,833 @@ def sanitize_filename(filename):
         logger.error(f"Error sanitizing filename: {str(e)}")
         return filename
 
-def get_video_info(url):
-    """Get video information using yt-dlp."""
+def content_disposition(download_name):
+    """Return an attachment Content-Disposition header for download_name, quoted the way send_file does.
+
+    Names outside ASCII get an ASCII fallback plus an RFC 5987
+    filename*=UTF-8'' form, so titles in any script still encode as Latin-1.
+    """
     try:
-        clean_url = clean_youtube_url(url)
-        logger.info(f"Processing URL: {clean_url}")
-
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': True,
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-us,en;q=0.5',
-                'Sec-Fetch-Mode': 'navigate',
-            },
-            'format': 'best',
-            'nocheckcertificate': True,
-            'ignoreerrors': True,
-            'no_color': True,
-            'geo_bypass': True,
-            'geo_verification_proxy': None,
-            'socket_timeout': 30,
-            'retries': 3,
-            'cookiesfrombrowser': None,  # Disable browser cookies
-            'extractor_args': {
-                'youtube': {
-                    'skip': ['dash', 'hls'],
-                    'player_client': ['android'],
-                    'player_skip': ['js', 'configs', 'webpage'],
-                }
+        download_name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        quoted = quote(download_name, safe="!#$&+-.^_`|~")
+        names = {'filename': simple, 'filename*': f"UTF-8''{quoted}"}
+    else:
+        names = {'filename': download_name}
+    return dump_options_header('attachment', names)
+
+class YDLErrorLog:
+    """yt-dlp logger that keeps the last error, which ignoreerrors would otherwise swallow."""
+
+    def __init__(self):
+        self.last_error = None
+
+    def debug(self, msg):
+        pass
+
+    def warning(self, msg):
+        pass
+
+    def error(self, msg):
+        self.last_error = msg
+
+def extract_video_info(clean_url):
+    """Run a full yt-dlp extraction for a cleaned URL."""
+    logger.info(f"Extracting video info: {clean_url}")
+
+    error_log = YDLErrorLog()
+    ydl_opts = {
+        'logger': error_log,
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': True,
+        'http_headers': YDL_HTTP_HEADERS,
+        'format': 'best',
+        'nocheckcertificate': True,
+        'ignoreerrors': True,
+        'no_color': True,
+        'geo_bypass': True,
+        'geo_verification_proxy': None,
+        'socket_timeout': 30,
+        'retries': 3,
+        'cookiesfrombrowser': None,  # Disable browser cookies
+        'extractor_args': {
+            'youtube': {
+                'skip': ['hls'],
+                'player_client': ['android'],
+                'player_skip': ['js', 'configs', 'webpage'],
             }
         }
+    }
 
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(clean_url, download=False)
+        if not info:
+            if error_log.last_error:
+                raise yt_dlp.utils.DownloadError(error_log.last_error)
+            raise Exception("Could not extract video information")
+        return info
+
+def run_extraction(extract):
+    """Run a yt-dlp call in an extraction slot, backing off globally if YouTube throttles it."""
+    with extraction_limiter.slot():
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                # Get video info
-                info = ydl.extract_info(clean_url, download=False)
-                if not info:
-                    raise Exception("Could not extract video information")
-
-                formats = []
-                
-                # Process video formats
-                for f in info.get('formats', []):
-                    if f.get('vcodec', 'none') != 'none' and f.get('acodec', 'none') != 'none':
-                        format_info = {
-                            'format_id': f.get('format_id'),
-                            'ext': f.get('ext', 'mp4'),
-                            'resolution': f.get('resolution', 'unknown'),
-                            'height': f.get('height'),
-                            'width': f.get('width'),
-                            'fps': f.get('fps'),
-                            'vcodec': f.get('vcodec'),
-                            'acodec': f.get('acodec'),
-                            'vbr': f.get('vbr'),
-                            'abr': f.get('abr'),
-                            'filesize': f.get('filesize'),
-                            'format_note': f.get('format_note', ''),
-                            'type': 'video'
-                        }
-                        formats.append(format_info)
-                    elif f.get('acodec', 'none') != 'none' and f.get('vcodec', 'none') == 'none':
-                        format_info = {
-                            'format_id': f.get('format_id'),
-                            'ext': f.get('ext', 'mp3'),
-                            'acodec': f.get('acodec'),
-                            'abr': f.get('abr'),
-                            'filesize': f.get('filesize'),
-                            'format_note': f'Audio {f.get("abr", "unknown")}',
-                            'type': 'audio'
-                        }
-                        formats.append(format_info)
-
-                if not formats:
-                    raise Exception("No valid formats found for this video")
+            with extract_seconds.time():
+                return extract()
+        except Exception as e:
+            if any(marker in str(e) for marker in THROTTLE_MARKERS):
+                upstream_backoff.throttled(str(e))
+                raise Overloaded("YouTube is rate limiting requests", upstream_backoff.cooldown()) from e
+            raise
 
-                return {
-                    'success': True,
-                    'title': info.get('title', 'Unknown Title'),
-                    'author': info.get('uploader', 'Unknown Author'),
-                    'thumbnail': info.get('thumbnail', ''),
-                    'duration': info.get('duration', 0),
-                    'views': info.get('view_count', 0),
-                    'formats': formats
-                }
+def expand_playlist(url):
+    """Return the watch URLs of a playlist's videos without extracting each one."""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'http_headers': YDL_HTTP_HEADERS,
+        'socket_timeout': 30,
+        'playlistend': MAX_JOB_ITEMS,
+    }
+
+    def extract():
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    info = run_extraction(extract)
+    if not info:
+        raise Exception("Could not extract playlist information")
+    entries = [e for e in info.get('entries') or [] if e and e.get('id')]
+    return [f"https://www.youtube.com/watch?v={e['id']}" for e in entries][:MAX_JOB_ITEMS]
+
+def metadata_ttl(info):
+    """Return how long extracted info may be cached, based on the signed URL expiry."""
+    expiries = []
+    for f in info.get('formats', []):
+        expire = parse_qs(urlparse(f.get('url', '')).query).get('expire')
+        if expire and expire[0].isdigit():
+            expiries.append(int(expire[0]))
+    if not expiries:
+        return METADATA_CACHE_MAX_TTL
+    ttl = min(expiries) - time.time() - SIGNED_URL_EXPIRY_MARGIN
+    return max(0, min(ttl, METADATA_CACHE_MAX_TTL))
+
+def trim_video_info(info):
+    """Return the parts of an extraction the app reads, for keeping in the metadata cache."""
+    trimmed = {key: info[key] for key in METADATA_INFO_FIELDS if info.get(key) is not None}
+    trimmed['formats'] = [
+        {key: f[key] for key in METADATA_FORMAT_FIELDS if f.get(key) is not None}
+        for f in info.get('formats') or []
+    ]
+    return trimmed
+
+def load_video_info(url):
+    """Return extracted video info, served from the metadata cache when possible."""
+    clean_url = clean_youtube_url(url)
+    video_id = get_video_id(clean_url)
+
+    def extract():
+        info = run_extraction(lambda: extract_video_info(clean_url))
+        if info:
+            info = trim_video_info(info)
+            # Index formats once here so every later selection is a lookup
+            FormatIndex.of(info)
+        return info
+
+    return metadata_cache.get_or_load(video_id, extract, ttl_func=metadata_ttl)
+
+def format_preference(format_id, extract_audio=False):
+    """Return the Preference for 'best' or a spec such as '<=1080p, vp9>h264, smallest', or None."""
+    if format_id in (None, '', 'best'):
+        return BEST_AUDIO_PREFERENCE if extract_audio else BEST_PREFERENCE
+    try:
+        pref = parse_preference(format_id)
+    except FormatSpecError:
+        # Not a spec, so an ID of a format this video does not have
+        return None
+    return pref._replace(audio_only=True) if extract_audio else pref
+
+def select_formats(info, format_id, extract_audio=False):
+    """Pick the format to stream (by format ID, 'best', or a preference spec) and the audio to mux with it.
+
+    Returns (format, audio); audio is None unless the format is video-only,
+    and then follows any audio codecs the spec names.
+    """
+    index = FormatIndex.of(info)
+    format_to_download = index.by_id.get(format_id)
+    audio = None
+    if format_to_download is not None and extract_audio and not index.is_audio_only(format_to_download):
+        # Audio is extracted from the best audio stream, whichever video was picked
+        format_to_download = index.select(BEST_AUDIO_PREFERENCE)
+    elif format_to_download is not None:
+        if not extract_audio and not codec_family(format_to_download.get('acodec')):
+            audio = index.mux_audio()
+    else:
+        pref = format_preference(format_id, extract_audio)
+        format_to_download, audio = index.best_pair(pref) if pref else (None, None)
+
+    if not format_to_download:
+        raise Exception("Could not find suitable format")
+    return format_to_download, audio
+
+def select_format(info, format_id, extract_audio=False):
+    """Pick the format to stream: by format ID, 'best', or a preference spec."""
+    return select_formats(info, format_id, extract_audio)[0]
+
+def requested_byte_range(fmt):
+    """Return the (start, end) byte range the client asked for, or None for the whole file."""
+    return parse_byte_range(request.headers.get('Range'), fmt)
+
+def parse_byte_range(header, fmt):
+    """Parse a Range header into an inclusive (start, end) pair for fmt, or None for the whole file.
+
+    end is None for "to the end of the file". Multi-range requests are
+    answered with the whole file, which RFC 9110 allows.
+    """
+    byte_range = parse_range_header(header)
+    if byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+        return None
+    start, stop = byte_range.ranges[0]
+    if start < 0:
+        # Suffix ranges need the exact size up front
+        size = fmt.get('filesize')
+        if not size:
+            return None
+        return max(0, size + start), size - 1
+    return start, None if stop is None else stop - 1
+
+def is_segmented(fmt, start=0, end=None):
+    """Return True if a transfer is large enough to be fetched as concurrent segments."""
+    size_hint = end + 1 if end is not None else fmt.get('filesize') or fmt.get('filesize_approx') or 0
+    return SEGMENT_CONCURRENCY > 1 and size_hint - start >= SEGMENTED_MIN_SIZE
+
+def open_upstream(fmt, start=0, end=None):
+    """Open the direct URL for a format, starting at byte start.
+
+    Large transfers are requested with a range covering only the first
+    segment; the 206 reply both confirms the URL works and reports the
+    exact total size the remaining segments are planned from.
+    """
+    headers = dict(fmt.get('http_headers') or {})
+    if is_segmented(fmt, start, end):
+        first_end = start + SEGMENT_SIZE - 1
+        headers['Range'] = f'bytes={start}-{first_end if end is None else min(first_end, end)}'
+    elif start or end is not None:
+        headers['Range'] = f'bytes={start}-{"" if end is None else end}'
+    upstream = upstream_transport.get(fmt['url'], headers=headers)
+    upstream_ttfb_seconds.observe(upstream.elapsed.total_seconds())
+    return upstream
+
+def upstream_extent(upstream, start=0, end=None):
+    """Return (last_byte, total_size) for a ranged upstream reply, or None if it was not ranged."""
+    if upstream.status_code != 206:
+        return None
+    content_range = parse_content_range(upstream.headers.get('Content-Range'))
+    if not content_range or not content_range[2]:
+        return None
+    total = content_range[2]
+    return (total - 1 if end is None else min(end, total - 1)), total
+
+def iter_upstream(fmt, upstream, start=0, end=None):
+    """Yield the body of an opened upstream response, fetching the rest in segments if it was ranged."""
+    extent = upstream_extent(upstream, start, end)
+    if extent:
+        fetched_from, fetched_to = parse_content_range(upstream.headers['Content-Range'])[:2]
+        if fetched_to < extent[0]:
+            return segmented_fetcher.iter_range(
+                fmt['url'], fmt.get('http_headers'), start, extent[0],
+                first_response=upstream
+            )
+        if fetched_to > extent[0]:
+            # Never send more than the Content-Length promised to the client
+            return truncate_chunks(upstream_transport.iter_chunks(upstream), extent[0] - fetched_from + 1)
+    return upstream_transport.iter_chunks(upstream)
+
+def truncate_chunks(chunks, limit):
+    """Yield at most limit bytes from chunks, closing them early once the limit is reached."""
+    try:
+        for chunk in chunks:
+            if len(chunk) >= limit:
+                yield chunk[:limit]
+                return
+            limit -= len(chunk)
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+def open_fresh_upstream(url, video_id, fmt, pick, start=0, end=None):
+    """Open a format's direct URL, re-extracting once if the signed URL was revoked.
+
+    Signed URLs can be rejected before their expiry; pick(info) selects
+    the same format again from the fresh extraction. Returns (fmt, upstream).
+    """
+    upstream = open_upstream(fmt, start, end)
+    if upstream.status_code == 403:
+        upstream.close()
+        logger.info(f"Direct URL rejected for {video_id}, re-extracting")
+        metadata_cache.invalidate(video_id)
+        fmt = pick(load_video_info(url))
+        upstream = open_upstream(fmt, start, end)
+    if upstream.status_code == 429:
+        # The transport has already told upstream_backoff
+        upstream.close()
+        raise Overloaded("YouTube is rate limiting downloads", upstream_backoff.cooldown())
+    return fmt, upstream
+
+def cached_response(cache_name, mimetype, download_name, byte_range=None):
+    """Serve a file from the content cache, or None if it has not been fetched.
+
+    Files still being filled can only be followed from the start, so
+    ranged requests for them return None and go upstream instead.
+    """
+    cached_path = content_cache.lookup(cache_name)
+    if cached_path:
+        requests_total.inc(endpoint='download', outcome='cached')
+        return send_file(
+            cached_path,
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=download_name,
+            conditional=True
+        )
+
+    # Follow a fill that another request is still writing
+    fill = content_cache.pending(cache_name)
+    if fill and not byte_range:
+        headers = {'Content-Disposition': content_disposition(download_name)}
+        if fill.expected_size:
+            headers['Content-Length'] = str(fill.expected_size)
+        requests_total.inc(endpoint='download', outcome='cached')
+        return Response(metered(content_cache.follow(fill), 'follow'), headers=headers, mimetype=mimetype)
+    return None
+
+def plan_download(video_id, info, format_id, extract_audio=False, audio_format='mp3'):
+    """Decide how a download is produced: proxied as-is, transcoded to audio, or muxed from DASH streams."""
+    index = FormatIndex.of(info)
+    fmt, audio = select_formats(info, format_id, extract_audio)
+    title = sanitize_filename(info.get('title', 'video'))
+    plan = {
+        'fmt': fmt,
+        # A fresh extraction must yield the same format, not whatever a spec picks now
+        'pick': lambda fresh_info: select_format(fresh_info, fmt['format_id'], extract_audio),
+    }
+
+    if extract_audio:
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Unsupported audio format: {audio_format}")
+        target = AUDIO_FORMATS[audio_format]
+        plan.update({
+            'kind': 'audio',
+            'audio_format': audio_format,
+            'cache_name': content_cache.filename(video_id, f"{fmt['format_id']}-{audio_format}", target['ext']),
+            'mimetype': target['mimetype'],
+            'download_name': f"{title}.{target['ext']}",
+            'estimated_size': int((info.get('duration') or 0) * AUDIO_BITRATE_KBPS * 125),
+        })
+    elif fmt.get('acodec') == 'none':
+        if audio is None:
+            raise Exception("Could not find an audio format to merge")
+        plan.update({
+            'kind': 'mux',
+            'audio': audio,
+            'cache_name': content_cache.filename(video_id, f"{fmt['format_id']}+{audio['format_id']}", 'mp4'),
+            'mimetype': 'video/mp4',
+            'download_name': f"{title}.mp4",
+            'estimated_size': sum(index.size(f) or 0 for f in (fmt, audio)),
+        })
+    else:
+        ext = fmt.get('ext', 'mp4')
+        plan.update({
+            'kind': 'direct',
+            'cache_name': content_cache.filename(video_id, fmt['format_id'], ext),
+            'mimetype': MEDIA_TYPES.get(ext, 'application/octet-stream'),
+            'download_name': f"{title}.{ext}",
+            'estimated_size': index.size(fmt),
+        })
+    return plan
+
+def open_plan_body(url, video_id, plan):
+    """Open the whole output of a download plan. Returns (chunks, exact_size_or_None)."""
+    fmt = plan['fmt']
+
+    if plan['kind'] == 'mux':
+        # Probe the video URL with a one-byte range so revoked URLs are refreshed first
+        probed_fmt, probe = open_fresh_upstream(url, video_id, fmt, plan['pick'], 0, 0)
+        probe.close()
+        audio = plan['audio']
+        if probed_fmt is not fmt:
+            fresh_index = FormatIndex.of(load_video_info(url))
+            audio = fresh_index.by_id.get(audio['format_id']) or fresh_index.mux_audio((codec_family(audio.get('acodec')),))
+        if probe.status_code >= 400:
+            probe.raise_for_status()
+        return ffmpeg_pipeline.mux(probed_fmt['url'], audio['url'], headers=probed_fmt.get('http_headers')), None
+
+    def open_body():
+        opened_fmt, upstream = open_fresh_upstream(url, video_id, fmt, plan['pick'])
+        if upstream.status_code >= 400:
+            upstream.close()
+            upstream.raise_for_status()
+        return opened_fmt, upstream
+
+    if plan['kind'] == 'audio':
+        def open_feed():
+            opened_fmt, upstream = open_body()
+            return ClosingChunks(iter_upstream(opened_fmt, upstream), upstream)
+
+        # The ffmpeg slot is taken before upstream is opened, so queueing for it holds no connection
+        return ffmpeg_pipeline.audio(open_feed, plan['audio_format'], f'{AUDIO_BITRATE_KBPS}k'), None
+
+    fmt, upstream = open_body()
+    extent = upstream_extent(upstream)
+    if extent:
+        size = extent[1]
+    else:
+        size = int(upstream.headers['Content-Length']) if upstream.headers.get('Content-Length') else None
+    return iter_upstream(fmt, upstream), size
+
+def stream_direct(url, video_id, plan, byte_range):
+    """Proxy a format's bytes as-is, honouring the requested byte range."""
+    mimetype = plan['mimetype']
+    start, end = byte_range or (0, None)
+    format_to_download, upstream = open_fresh_upstream(url, video_id, plan['fmt'], plan['pick'], start, end)
+
+    if upstream.status_code == 416:
+        upstream.close()
+        size = format_to_download.get('filesize')
+        return Response(status=416, headers={'Content-Range': f'bytes */{size}'} if size else {})
+
+    if upstream.status_code >= 400:
+        upstream.close()
+        upstream.raise_for_status()
+
+    # Set up the response headers
+    status = 200
+    headers = {
+        'Content-Type': mimetype,
+        'Content-Disposition': content_disposition(plan['download_name']),
+        'Accept-Ranges': 'bytes',
+    }
+    extent = upstream_extent(upstream, start, end)
+    if extent and start > extent[0]:
+        upstream.close()
+        return Response(status=416, headers={'Content-Range': f'bytes */{extent[1]}'})
+    if extent:
+        last, total = extent
+        headers['Content-Length'] = str(last - start + 1)
+        if byte_range:
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{last}/{total}'
+    else:
+        # Unknown lengths are omitted rather than guessed
+        if upstream.headers.get('Content-Length'):
+            headers['Content-Length'] = upstream.headers['Content-Length']
+        if upstream.status_code == 206 and byte_range:
+            status = 206
+            headers['Content-Range'] = upstream.headers.get('Content-Range')
+
+    # Stream the response, keeping a copy of whole-file transfers
+    body = iter_upstream(format_to_download, upstream, start, end)
+    if not byte_range:
+        expected_size = int(headers['Content-Length']) if 'Content-Length' in headers else None
+        body = content_cache.tee(plan['cache_name'], body, expected_size=expected_size)
+    body, close_unstarted = close_if_unstarted(body, upstream)
+
+    response = Response(
+        metered(body, 'direct'),
+        status=status,
+        headers=headers,
+        mimetype=mimetype
+    )
+    # The body never starts if the client goes away first, so close upstream with the response too
+    response.call_on_close(close_unstarted)
+    return response
+
+class ClosingChunks:
+    """Iterator over chunks whose close() also closes resource, even if iteration never started."""
+
+    def __init__(self, chunks, resource):
+        self.chunks = iter(chunks)
+        self.resource = resource
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close:
+            close()
+        self.resource.close()
+
+def close_if_unstarted(chunks, resource):
+    """Wrap chunks so that the returned close() releases resource only if they were never iterated.
+
+    Once iteration starts, the chunks own resource: a cache fill handed to
+    a background drain must keep reading it after the response is closed.
+    """
+    started = False
+
+    def body():
+        nonlocal started
+        started = True
+        yield from chunks
+
+    def close():
+        if not started:
+            resource.close()
+
+    return body(), close
+
+def head_response(plan):
+    """Answer a HEAD for a download from the plan and content cache alone, without going upstream."""
+    cached_path = content_cache.lookup(plan['cache_name'])
+    if cached_path:
+        return send_file(cached_path, mimetype=plan['mimetype'], as_attachment=True,
+                         download_name=plan['download_name'], conditional=True)
+
+    # An empty iterator as the body stops werkzeug claiming Content-Length: 0
+    headers = {'Content-Disposition': content_disposition(plan['download_name'])}
+    if plan['kind'] != 'direct':
+        # ffmpeg output has no length until it is produced, and no ranges until cached
+        return Response(iter(()), headers=headers, mimetype=plan['mimetype'])
+
+    headers['Accept-Ranges'] = 'bytes'
+    status = 200
+    size = plan['fmt'].get('filesize')
+    if size:
+        byte_range = requested_byte_range(plan['fmt'])
+        start, end = byte_range or (0, size - 1)
+        if start >= size:
+            return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+        end = size - 1 if end is None else min(end, size - 1)
+        headers['Content-Length'] = str(end - start + 1)
+        if byte_range:
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return Response(iter(()), status=status, headers=headers, mimetype=plan['mimetype'])
+
+def stream_transcoded(url, video_id, plan):
+    """Stream a plan's output through ffmpeg, either transcoding audio or muxing DASH streams.
+
+    The output length is unknown until ffmpeg finishes, so no
+    Content-Length is sent and Range is only honoured once the result is
+    in the content cache.
+    """
+    cached = cached_response(plan['cache_name'], plan['mimetype'], plan['download_name'], request.range)
+    if cached is not None:
+        return cached
+
+    def respond():
+        body, _ = open_plan_body(url, video_id, plan)
+        return Response(
+            metered(content_cache.tee(plan['cache_name'], body), plan['kind']),
+            headers={'Content-Disposition': content_disposition(plan['download_name'])},
+            mimetype=plan['mimetype']
+        )
+
+    return admit_stream(respond)
+
+def admit_stream(respond, *args):
+    """Return respond(*args), holding a stream slot until that response is closed."""
+    stream_limiter.acquire()
+    try:
+        response = respond(*args)
+    except BaseException:
+        stream_limiter.release()
+        raise
+    response.call_on_close(stream_limiter.release)
+    requests_total.inc(endpoint='download', outcome='ok' if response.status_code < 400 else 'error')
+    return response
+
+def record_stream(kind, duration, size, upstream_seconds, client_seconds):
+    """Record the timings of one finished stream."""
+    stream_seconds.observe(duration, kind=kind)
+    stream_stage_seconds.observe(upstream_seconds, kind=kind, stage='upstream')
+    stream_stage_seconds.observe(client_seconds, kind=kind, stage='client')
+    stream_bytes_total.inc(size, kind=kind)
+    if size and duration > 0:
+        stream_bytes_per_second.observe(size / duration, kind=kind)
+
+def metered(chunks, kind):
+    """Wrap a response body so its duration, throughput and backpressure are recorded when it ends."""
+    return StreamMeter(chunks, lambda meter: record_stream(
+        kind, meter.duration, meter.bytes, meter.upstream_seconds, meter.client_seconds
+    ))
+
+def overloaded_response(e, message=None):
+    """Return a 503 telling the client when to retry."""
+    response = jsonify({
+        'success': False,
+        'message': message or f'The server is busy. Please try again in {e.retry_after} seconds.'
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def download_job_item(url, options, progress):
+    """Fetch one job item into the content cache and describe the finished file."""
+    clean_url = clean_youtube_url(url)
+    video_id = get_video_id(clean_url)
+    bind_log_context(video_id=video_id, format_id=options['format_id'])
+    # The preview handle only applies to the video it was issued for
+    info = resolve_download_handle(options.get('handle'), video_id) or load_video_info(url)
+    plan = plan_download(video_id, info, options['format_id'], options['extract_audio'], options['audio_format'])
+    bind_log_context(format_id=plan['fmt']['format_id'])
+    cache_name = plan['cache_name']
+
+    cached_path = content_cache.lookup(cache_name)
+    if cached_path:
+        size = os.path.getsize(cached_path)
+        progress(size, size)
+    else:
+        fill = content_cache.pending(cache_name)
+        estimate = plan['estimated_size']
+        if not fill and estimate and not content_cache.has_room(estimate):
+            # Job results are served from the cache, so there is no point fetching what it cannot hold
+            if estimate > content_cache.max_bytes:
+                raise Exception("File is larger than the content cache allows")
+            raise Overloaded("The content cache is full of downloads in progress", ADMISSION_RETRY_AFTER)
+        # Fetching from YouTube takes a stream slot like /download, so jobs
+        # queue behind interactive downloads and honour the throttling cooldown
+        with contextlib.nullcontext() if fill else stream_limiter.slot():
+            if fill:
+                body, size = content_cache.follow(fill), fill.expected_size
+            else:
+                body, size = open_plan_body(url, video_id, plan)
+                body = content_cache.tee(cache_name, body, expected_size=size)
+
+            bytes_done = 0
+            last_report = 0
+            try:
+                for chunk in body:
+                    bytes_done += len(chunk)
+                    now = time.monotonic()
+                    if now - last_report >= JOB_PROGRESS_INTERVAL:
+                        last_report = now
+                        progress(bytes_done, size or max(plan['estimated_size'] or 0, bytes_done) or None)
+            finally:
+                close = getattr(body, 'close', None)
+                if close:
+                    close()
+        progress(bytes_done, bytes_done)
+
+        # Another request may have been filling the same file while ours passed through
+        fill = content_cache.pending(cache_name)
+        if fill:
+            content_cache.wait(fill)
+        if not content_cache.lookup(cache_name):
+            raise Exception("Download did not complete")
+
+    return {
+        'title': info.get('title', 'Unknown Title'),
+        'filename': cache_name,
+        'download_name': plan['download_name'],
+        'file_url': '/get_file?' + urlencode({'filename': cache_name, 'name': plan['download_name']}),
+    }
+
+def create_download_handle(video_id, info):
+    """Return a signed handle carrying the resolved formats, so /download can start without extracting."""
+    ttl = min(metadata_ttl(info), DOWNLOAD_HANDLE_TTL)
+    formats = [
+        {key: f[key] for key in HANDLE_FORMAT_FIELDS if f.get(key) is not None}
+        for f in FormatIndex.of(info).by_id.values()
+    ]
+    return handle_serializer.dumps({
+        'v': video_id,
+        'exp': int(time.time() + ttl),
+        'info': {'id': video_id, 'title': info.get('title'), 'duration': info.get('duration'), 'formats': formats},
+    })
+
+def resolve_download_handle(handle, video_id):
+    """Return the extraction info a handle carries, or None if it is invalid, expired or for another video."""
+    if not handle:
+        return None
+    try:
+        payload = handle_serializer.loads(handle)
+    except BadSignature:
+        return None
+    if payload.get('exp', 0) <= time.time() or payload.get('v') != video_id:
+        return None
+    return payload.get('info')
+
+def static_version(filename):
+    """Return a short hash of a static file's contents, or None if it does not exist."""
+    path = safe_join(app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except (TypeError, OSError):
+        return None
+    cached = _static_versions.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        version = hashlib.sha256(f.read()).hexdigest()[:12]
+    _static_versions[filename] = (mtime, version)
+    return version
+
+def thumbnail_url(info):
+    """Return the cached /thumb path for an extraction, or yt-dlp's thumbnail URL if it has no usable ID."""
+    video_id = info.get('id') or ''
+    if re.fullmatch(r'[\w-]{11}', video_id):
+        return f"/thumb/{video_id}"
+    return info.get('thumbnail')
+
+def get_video_info(url):
+    """Get video information using yt-dlp."""
+    try:
+        logger.info(f"Processing URL: {clean_youtube_url(url)}")
+
+        try:
+            info = load_video_info(url)
+
+            index = FormatIndex.of(info)
+            formats = []
+            
+            # Process video formats, best first, then audio-only formats
+            for f in index.video + index.audio:
+                if f.get('vcodec', 'none') != 'none':
+                    format_info = {
+                        'format_id': f.get('format_id'),
+                        'ext': f.get('ext', 'mp4'),
+                        'resolution': f.get('resolution', 'unknown'),
+                        'height': f.get('height'),
+                        'width': f.get('width'),
+                        'fps': f.get('fps'),
+                        'vcodec': f.get('vcodec'),
+                        'acodec': f.get('acodec'),
+                        'vbr': f.get('vbr'),
+                        'abr': f.get('abr'),
+                        'filesize': index.size(f),
+                        'format_note': f.get('format_note', ''),
+                        'type': 'video'
+                    }
+                    # Video-only DASH formats are muxed with the best audio on download
+                    formats.append(format_info)
+                else:
+                    format_info = {
+                        'format_id': f.get('format_id'),
+                        'ext': f.get('ext', 'mp3'),
+                        'acodec': f.get('acodec'),
+                        'abr': f.get('abr'),
+                        'filesize': index.size(f),
+                        'format_note': f'Audio {f.get("abr", "unknown")}',
+                        'type': 'audio'
+                    }
+                    formats.append(format_info)
+
+            if not formats:
+                raise Exception("No valid formats found for this video")
+
+            requests_total.inc(endpoint='preview', outcome='ok')
+            return {
+                'success': True,
+                'handle': create_download_handle(get_video_id(url), info),
+                'title': info.get('title', 'Unknown Title'),
+                'author': info.get('uploader', 'Unknown Author'),
+                'thumbnail': thumbnail_url(info),
+                'duration': info.get('duration', 0),
+                'views': info.get('view_count', 0),
+                'formats': formats
+            }
 
         except yt_dlp.utils.DownloadError as e:
             error_message = str(e)
             logger.error(f"Download error: {error_message}")
             
             if "Video unavailable" in error_message:
+                requests_total.inc(endpoint='preview', outcome='unavailable')
                 return {
                     'success': False,
                     'message': 'This video is unavailable. It may be private or restricted.'
                 }
             elif "Video is private" in error_message:
+                requests_total.inc(endpoint='preview', outcome='private')
                 return {
                     'success': False,
                     'message': 'This video is private. Please use a public video URL.'
                 }
             elif "Sign in to confirm your age" in error_message:
+                requests_total.inc(endpoint='preview', outcome='age_restricted')
                 return {
                     'success': False,
                     'message': 'This video requires age verification. Please try a different video.'
                 }
             else:
+                requests_total.inc(endpoint='preview', outcome='error')
                 return {
                     'success': False,
                     'message': f'Error loading video information: {error_message}'
                 }
 
+    except Overloaded:
+        requests_total.inc(endpoint='preview', outcome='overloaded')
+        raise
     except Exception as e:
         error_message = str(e)
-        logger.error(f"Error in get_video_info: {error_message}\n{traceback.format_exc()}")
+        logger.error(f"Error in get_video_info: {error_message}", exc_info=True)
+        requests_total.inc(endpoint='preview', outcome='error')
         return {
             'success': False,
             'message': f'Error loading video information: {error_message}'
         }
 
+job_manager = JobManager(
+    download_job_item,
+    max_workers=JOB_WORKERS,
+    per_job_concurrency=JOB_PER_JOB_CONCURRENCY,
+    max_pending_jobs=JOB_MAX_PENDING,
+    retention=JOB_RETENTION,
+    max_deferrals=JOB_MAX_DEFERRALS
+)
+
+@app.before_request
+def assign_request_id():
+    """Tag this request's log records with an ID, reusing a well-formed X-Request-ID from the client."""
+    clear_log_context()
+    request_id = request.headers.get('X-Request-ID', '')
+    if not re.fullmatch(r'[\w.-]{1,64}', request_id):
+        request_id = uuid.uuid4().hex[:16]
+    g.request_id = request_id
+    bind_log_context(request_id=request_id)
+
+@app.after_request
+def add_request_id_header(response):
+    """Echo the request ID so clients can quote it when reporting problems."""
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.after_request
+def cache_static_assets(response):
+    """Let browsers keep versioned static files for a year without revalidating."""
+    if request.endpoint == 'static' and response.status_code in (200, 304):
+        version = request.args.get('v')
+        if version and version == static_version(request.view_args['filename']):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+    return response
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    """Append the content hash to url_for('static', ...) links."""
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        version = static_version(values['filename'])
+        if version:
+            values['v'] = version
+
+@app.teardown_request
+def release_log_context(exc):
+    """Stop later log records on this thread being attributed to the finished request."""
+    clear_log_context()
+
 @app.route('/')
 def index():
     """Render the main page."""
@@ -211,6 +1210,7 @@ def preview_video():
 
         if not is_valid_youtube_url(url):
             return jsonify({'success': False, 'message': 'Invalid YouTube URL format'}), 400
+        bind_log_context(video_id=get_video_id(url))
 
         try:
             video_info = get_video_info(url)
@@ -221,6 +1221,9 @@ def preview_video():
                     'success': False,
                     'message': 'Could not load video information. Please try again.'
                 }), 400
+        except Overloaded as e:
+            logger.info(f"Rejecting preview: {str(e)}")
+            return overloaded_response(e)
         except Exception as e:
             error_message = str(e)
             logger.error(f"YouTube API error: {error_message}")
@@ -242,23 +1245,30 @@ def preview_video():
                 }), 400
 
     except Exception as e:
-        logger.error(f"Preview error: {str(e)}\n{traceback.format_exc()}")
+        logger.error(f"Preview error: {str(e)}", exc_info=True)
         return jsonify({'success': False, 'message': 'Server error occurred'}), 500
 
-@app.route('/download', methods=['POST'])
+@app.route('/download', methods=['GET', 'POST'])
 def download_video():
-    """Download YouTube video using yt-dlp and stream directly to client."""
+    """Download YouTube video using yt-dlp and stream directly to client.
+
+    GET accepts the same fields as query parameters, giving browsers and
+    download managers a plain URL they can resume with Range requests.
+    """
     try:
-        if not request.is_json:
-            return jsonify({'success': False, 'message': 'Invalid request format'}), 400
+        if request.method == 'POST':
+            if not request.is_json:
+                return jsonify({'success': False, 'message': 'Invalid request format'}), 400
+            data = request.get_json()
+        else:
+            data = request.args
 
-        data = request.get_json()
         if not data or 'url' not in data:
             return jsonify({'success': False, 'message': 'No URL provided'}), 400
 
         url = data.get('url', '').strip()
         format_id = data.get('format_id', 'best')
-        extract_audio = data.get('extract_audio', False)
+        extract_audio = parse_flag(data.get('extract_audio', False))
 
         if not url:
             return jsonify({'success': False, 'message': 'Please provide a YouTube URL'}), 400
@@ -268,102 +1278,74 @@ def download_video():
 
         try:
             clean_url = clean_youtube_url(url)
+            video_id = get_video_id(clean_url)
+            bind_log_context(video_id=video_id, format_id=format_id)
             logger.info(f"Processing download for URL: {clean_url}")
 
-            # Configure yt-dlp options for direct streaming
-            ydl_opts = {
-                'format': f'bestaudio/best' if extract_audio else format_id,
-                'quiet': True,
-                'no_warnings': True,
-                'http_headers': {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                    'Accept-Language': 'en-us,en;q=0.5',
-                    'Sec-Fetch-Mode': 'navigate',
-                },
-                'nocheckcertificate': True,
-                'ignoreerrors': True,
-                'no_color': True,
-                'geo_bypass': True,
-                'geo_verification_proxy': None,
-                'socket_timeout': 30,
-                'retries': 3,
-                'cookiesfrombrowser': None,
-                'extractor_args': {
-                    'youtube': {
-                        'skip': ['dash', 'hls'],
-                        'player_client': ['android'],
-                        'player_skip': ['js', 'configs', 'webpage'],
-                    }
-                },
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }] if extract_audio else [],
-            }
+            # A valid preview handle carries the extraction, so no yt-dlp call is needed
+            info = resolve_download_handle(data.get('handle'), video_id) or load_video_info(url)
 
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                # Get video info first
-                info = ydl.extract_info(clean_url, download=False)
-                if not info:
-                    raise Exception("Could not extract video information")
+            plan = plan_download(video_id, info, format_id, extract_audio, data.get('audio_format', 'mp3'))
+            bind_log_context(format_id=plan['fmt']['format_id'])
+            if request.method == 'HEAD':
+                return head_response(plan)
+            if plan['kind'] != 'direct':
+                return stream_transcoded(url, video_id, plan)
 
-                # Get the direct URL for the selected format
-                if extract_audio:
-                    format_to_download = next((f for f in info['formats'] if f.get('acodec') != 'none' and f.get('vcodec') == 'none'), None)
-                else:
-                    format_to_download = next((f for f in info['formats'] if f.get('format_id') == format_id), None)
+            byte_range = requested_byte_range(plan['fmt'])
 
-                if not format_to_download:
-                    raise Exception("Could not find suitable format")
+            # Serve from the content cache when this format was fetched before
+            cached = cached_response(plan['cache_name'], plan['mimetype'], plan['download_name'], byte_range)
+            if cached is not None:
+                return cached
 
-                # Get the direct URL
-                direct_url = format_to_download['url']
+            return admit_stream(stream_direct, url, video_id, plan, byte_range)
 
-                # Set up the response headers
-                headers = {
-                    'Content-Type': 'audio/mp3' if extract_audio else 'video/mp4',
-                    'Content-Disposition': f'attachment; filename="{sanitize_filename(info["title"])}.{"mp3" if extract_audio else "mp4"}"',
-                    'Content-Length': str(format_to_download.get('filesize', 0)),
-                }
+        except HTTPException as e:
+            # e.g. an unsatisfiable Range on a cached file
+            return e
 
-                # Stream the response
-                def generate():
-                    with requests.get(direct_url, stream=True) as r:
-                        r.raise_for_status()
-                        for chunk in r.iter_content(chunk_size=8192):
-                            if chunk:
-                                yield chunk
+        except TranscodeBusy as e:
+            logger.info("Rejecting download: all ffmpeg workers are busy")
+            requests_total.inc(endpoint='download', outcome='overloaded')
+            return overloaded_response(e, 'The server is busy converting other videos. Please try again shortly.')
 
-                return Response(
-                    generate(),
-                    headers=headers,
-                    mimetype='audio/mp3' if extract_audio else 'video/mp4'
-                )
+        except Overloaded as e:
+            logger.info(f"Rejecting download: {str(e)}")
+            requests_total.inc(endpoint='download', outcome='overloaded')
+            return overloaded_response(e)
 
         except Exception as e:
             error_message = str(e)
-            logger.error(f"YouTube API error: {error_message}\n{traceback.format_exc()}")
+            logger.error(f"YouTube API error: {error_message}", exc_info=True)
             
             if "Video unavailable" in error_message:
+                requests_total.inc(endpoint='download', outcome='unavailable')
                 return jsonify({
                     'success': False,
                     'message': 'This video is unavailable. It may be private or restricted.'
                 }), 400
             elif "Video is private" in error_message:
+                requests_total.inc(endpoint='download', outcome='private')
                 return jsonify({
                     'success': False,
                     'message': 'This video is private. Please use a public video URL.'
                 }), 400
+            elif "Sign in to confirm your age" in error_message:
+                requests_total.inc(endpoint='download', outcome='age_restricted')
+                return jsonify({
+                    'success': False,
+                    'message': 'This video requires age verification. Please try a different video.'
+                }), 400
             else:
+                requests_total.inc(endpoint='download', outcome='error')
                 return jsonify({
                     'success': False,
                     'message': f'Error downloading video: {error_message}'
                 }), 400
 
     except Exception as e:
-        logger.error(f"Download error: {str(e)}\n{traceback.format_exc()}")
+        logger.error(f"Download error: {str(e)}", exc_info=True)
         return jsonify({'success': False, 'message': 'Server error occurred'}), 500
 
 @app.route('/get_file')
@@ -374,19 +1356,162 @@ def get_file():
         if not filename:
             return jsonify({'success': False, 'message': 'No filename provided'}), 400
 
-        file_path = os.path.join(DOWNLOAD_FOLDER, filename)
-        if not os.path.exists(file_path):
+        file_path = safe_join(DOWNLOAD_FOLDER, filename)
+        if not file_path or filename.endswith('.part') or not os.path.isfile(file_path):
             return jsonify({'success': False, 'message': 'File not found'}), 404
+        content_cache.touch(filename)
 
+        # conditional=True answers Range and If-Range with 206 Partial Content
         return send_file(
             file_path,
             as_attachment=True,
-            download_name=filename
+            download_name=sanitize_filename(request.args.get('name') or filename),
+            conditional=True
         )
 
+    except HTTPException as e:
+        return e
+
     except Exception as e:
-        logger.error(f"File retrieval error: {str(e)}\n{traceback.format_exc()}")
+        logger.error(f"File retrieval error: {str(e)}", exc_info=True)
         return jsonify({'success': False, 'message': 'Error retrieving file'}), 500
 
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """Queue one URL, a list of URLs or a playlist for background download."""
+    try:
+        if not request.is_json:
+            return jsonify({'success': False, 'message': 'Invalid request format'}), 400
+
+        data = request.get_json()
+        if not data or not (data.get('url') or data.get('urls')):
+            return jsonify({'success': False, 'message': 'No URL provided'}), 400
+
+        urls = data.get('urls') or [data.get('url')]
+        if not isinstance(urls, list) or not all(isinstance(u, str) for u in urls):
+            return jsonify({'success': False, 'message': 'urls must be a list of YouTube URLs'}), 400
+
+        items = []
+        for url in (u.strip() for u in urls):
+            if is_playlist_url(url):
+                items.extend(expand_playlist(url))
+            elif is_valid_youtube_url(url):
+                items.append(url)
+            else:
+                return jsonify({'success': False, 'message': f'Invalid YouTube URL format: {url}'}), 400
+
+        if not items:
+            return jsonify({'success': False, 'message': 'No videos found to download'}), 400
+        if len(items) > MAX_JOB_ITEMS:
+            return jsonify({'success': False, 'message': f'A job can contain at most {MAX_JOB_ITEMS} videos'}), 400
+
+        extract_audio = parse_flag(data.get('extract_audio', False))
+        audio_format = data.get('audio_format', 'mp3')
+        if extract_audio and audio_format not in AUDIO_FORMATS:
+            return jsonify({'success': False, 'message': f'Unsupported audio format: {audio_format}'}), 400
+
+        job = job_manager.submit(items, {
+            'format_id': data.get('format_id', 'best'),
+            'extract_audio': extract_audio,
+            'audio_format': audio_format,
+            'handle': data.get('handle'),
+        })
+        logger.info(f"Queued job {job.id} with {len(items)} item(s)")
+        return jsonify({'success': True, 'job_id': job.id, 'items': len(items)}), 202
+
+    except JobQueueFull:
+        return jsonify({'success': False, 'message': 'Too many downloads are queued. Please try again later.'}), 503
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logger.error(f"Job creation error: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'message': f'Error creating download job: {str(e)}'}), 400
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Return the current state of a job."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    return jsonify({'success': True, **job.snapshot()})
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Push job progress to the browser as Server-Sent Events until it finishes."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+
+    def generate():
+        version = None
+        while True:
+            snapshot = job.snapshot()
+            if snapshot['version'] != version:
+                version = snapshot['version']
+                yield f"data: {json.dumps(snapshot)}\n\n"
+                if snapshot['status'] in FINISHED_STATES:
+                    return
+            else:
+                yield ': keep-alive\n\n'
+            job.wait_for_change(version, JOB_EVENT_KEEPALIVE)
+
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/thumb/<video_id>')
+def thumbnail(video_id):
+    """Serve a video's thumbnail from the thumbnail cache with a strong ETag."""
+    if not re.fullmatch(r'[\w-]{11}', video_id):
+        return jsonify({'success': False, 'message': 'Invalid video ID'}), 404
+
+    # Prefer the thumbnail yt-dlp picked if the video was extracted recently
+    info = metadata_cache.peek(video_id)
+    source_url = (info or {}).get('thumbnail') or THUMBNAIL_FALLBACK_URL.format(video_id=video_id)
+    try:
+        thumb = thumbnail_cache.get(video_id, source_url)
+    except Exception as e:
+        # Fall back to letting the browser load it from YouTube
+        logger.warning(f"Thumbnail unavailable for {video_id}: {str(e)}")
+        return redirect(source_url)
+
+    response = Response(thumb.data, mimetype=thumb.content_type)
+    response.set_etag(thumb.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = THUMBNAIL_MAX_AGE
+    return response.make_conditional(request)
+
+@app.route('/metrics')
+def metrics():
+    """Expose request counters, stream gauges and latency histograms in Prometheus text format."""
+    return Response(metrics_registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/stats')
+def stats():
+    """Report cache and upstream pool counters for monitoring."""
+    return jsonify({
+        'metadata_cache': metadata_cache.stats(),
+        'content_cache': content_cache.stats(),
+        'thumbnails': thumbnail_cache.stats(),
+        'ffmpeg': ffmpeg_pipeline.stats(),
+        'jobs': job_manager.stats(),
+        'logging': log_pipeline.stats(),
+        'upstream': upstream_transport.stats(),
+        'thumbnail_upstream': thumbnail_transport.stats(),
+        'admission': {
+            'extraction': extraction_limiter.stats(),
+            'streams': stream_limiter.stats(),
+            'backoff': upstream_backoff.stats(),
+        }
+    })
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Development server; see serve.py for production
+    app.run(
+        host=os.environ.get('HOST', 'localhost'),
+        port=int(os.environ.get('PORT', 5000)),
+        debug=os.environ.get('DEBUG', 'False').lower() in ('1', 'true', 'yes'),
+        threaded=True
+    )
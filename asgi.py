@@ -0,0 +1,606 @@
+"""ASGI entry point with non-blocking /preview and /download.
+
+Upstream media bytes are streamed with httpx on the event loop, large
+files as concurrent byte-range segments like the WSGI path, so slow
+clients cost a coroutine rather than an OS thread. Files already in the
+content cache are also served from the loop, with disk reads on a small
+thread pool. yt-dlp is synchronous, so extraction still runs in a thread
+pool, but concurrent requests for the same video await one extraction.
+Everything else - other routes, ffmpeg transcodes and muxes, and
+requests following a cache fill still being written - is handed to the
+Flask app through a2wsgi, which runs each request on its own thread from
+a pool of WEB_THREADS.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.utils import send_file
+
+import app as byteloader
+from limits import Overloaded
+from logging_config import bind_log_context, clear_log_context
+from segmented import SegmentError, SegmentThrottled, parse_content_range
+
+logger = logging.getLogger(__name__)
+
+# Streaming Flask responses (cached files, ffmpeg output, job events) each
+# hold one of these threads until they finish
+WSGI_THREADS = int(os.environ.get('WEB_THREADS', 64))
+
+flask_app = WSGIMiddleware(byteloader.app, workers=WSGI_THREADS)
+
+# Blocking work runs on pools of its own rather than the loop's default
+# executor. Extractions and admission waits can each block for seconds, so
+# they get enough threads for every slot and queue place their limiters
+# allow, and content cache writes, which every streaming chunk awaits, get
+# a separate pool they can never be starved of.
+extraction_executor = ThreadPoolExecutor(
+    byteloader.EXTRACT_CONCURRENCY + byteloader.EXTRACT_QUEUE_SIZE, thread_name_prefix='asgi-extract'
+)
+admission_executor = ThreadPoolExecutor(
+    byteloader.STREAM_CONCURRENCY + byteloader.STREAM_QUEUE_SIZE, thread_name_prefix='asgi-admission'
+)
+disk_executor = ThreadPoolExecutor(
+    int(os.environ.get('ASGI_DISK_THREADS', 8)), thread_name_prefix='asgi-disk'
+)
+
+# Size of each read when serving a file from the content cache
+CACHE_READ_SIZE = 1024 * 1024
+
+_client = None
+_inflight = {}
+
+
+def get_client():
+    """Return the shared pooled upstream client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=byteloader.UPSTREAM_POOL_SIZE),
+            timeout=httpx.Timeout(
+                connect=byteloader.UPSTREAM_CONNECT_TIMEOUT,
+                read=byteloader.UPSTREAM_READ_TIMEOUT,
+                write=byteloader.UPSTREAM_READ_TIMEOUT,
+                pool=None
+            ),
+            follow_redirects=True
+        )
+    return _client
+
+
+async def run_in(executor, func, *args):
+    """Run func(*args) on executor with the caller's context, like asyncio.to_thread."""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(context.run, func, *args))
+
+
+async def coalesce(key, func, *args):
+    """Run func(*args) on the extraction pool, sharing one call among concurrent awaiters of key."""
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(run_in(extraction_executor, func, *args))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def read_body(receive):
+    """Read the full request body."""
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return body
+
+
+def replay(body, receive):
+    """Return a receive callable that yields an already-read body again, for handing off to Flask."""
+    sent = False
+
+    async def replayed():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return await receive()
+
+    return replayed
+
+
+async def send_json(send, payload, status=200, headers=()):
+    """Send a complete JSON response."""
+    body = json.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_overloaded(send, e, endpoint=None):
+    """Send the same 503 and Retry-After as app.overloaded_response, counting it against endpoint."""
+    if endpoint:
+        byteloader.requests_total.inc(endpoint=endpoint, outcome='overloaded')
+    await send_json(send, {
+        'success': False,
+        'message': f'The server is busy. Please try again in {e.retry_after} seconds.'
+    }, 503, [(b'retry-after', str(e.retry_after).encode())])
+
+
+async def preview(scope, receive, send):
+    """Async /preview: same contract as the Flask route."""
+    try:
+        headers = dict(scope['headers'])
+        body = await read_body(receive)
+        if not headers.get(b'content-type', b'').startswith(b'application/json'):
+            return await send_json(send, {'success': False, 'message': 'Invalid request format'}, 400)
+        try:
+            data = json.loads(body or b'null')
+        except ValueError:
+            return await send_json(send, {'success': False, 'message': 'Invalid request format'}, 400)
+
+        if not isinstance(data, dict) or 'url' not in data:
+            return await send_json(send, {'success': False, 'message': 'No URL provided'}, 400)
+
+        url = (data.get('url') or '').strip()
+        if not url:
+            return await send_json(send, {'success': False, 'message': 'Please provide a YouTube URL'}, 400)
+
+        if not byteloader.is_valid_youtube_url(url):
+            return await send_json(send, {'success': False, 'message': 'Invalid YouTube URL format'}, 400)
+
+        video_id = byteloader.get_video_id(url)
+        bind_log_context(video_id=video_id)
+        video_info = await coalesce(('preview', video_id), byteloader.get_video_info, url)
+        if video_info and video_info['success']:
+            return await send_json(send, video_info)
+        return await send_json(send, {
+            'success': False,
+            'message': 'Could not load video information. Please try again.'
+        }, 400)
+
+    except Overloaded as e:
+        return await send_overloaded(send, e)
+    except Exception as e:
+        logger.error(f"Preview error: {str(e)}", exc_info=True)
+        return await send_json(send, {'success': False, 'message': 'Server error occurred'}, 500)
+
+
+async def open_upstream(fmt, byte_range, segmented=False):
+    """Open a streaming upstream request for fmt, forwarding the client's byte range.
+
+    Segmented transfers ask for the first segment only, as app.open_upstream
+    does; the 206 reply reports the total size the rest is planned from.
+    """
+    headers = dict(fmt.get('http_headers') or {})
+    start, end = byte_range or (0, None)
+    if segmented:
+        first_end = start + byteloader.SEGMENT_SIZE - 1
+        headers['Range'] = f'bytes={start}-{first_end if end is None else min(first_end, end)}'
+    elif byte_range:
+        headers['Range'] = f'bytes={start}-{"" if end is None else end}'
+    client = get_client()
+    started = time.perf_counter()
+    response = await client.send(client.build_request('GET', fmt['url'], headers=headers), stream=True)
+    byteloader.upstream_ttfb_seconds.observe(time.perf_counter() - started)
+    return response
+
+
+async def fetch_segment(fmt, start, end, slots):
+    """Fetch bytes start..end inclusive as a list of chunks, like SegmentedFetcher.fetch_range.
+
+    At most one request per slot runs at once. Failed or too slow attempts
+    resume from where they stopped; the last attempt has no deadline.
+    """
+    fetcher = byteloader.segmented_fetcher
+    client = get_client()
+    chunks = []
+    received = 0
+    attempt = 0
+
+    async def read(response):
+        nonlocal received
+        async for chunk in response.aiter_raw():
+            chunks.append(chunk)
+            received += len(chunk)
+
+    async with slots:
+        while True:
+            pos = start + received
+            try:
+                headers = {**(fmt.get('http_headers') or {}), 'Range': f'bytes={pos}-{end}'}
+                response = await client.send(client.build_request('GET', fmt['url'], headers=headers), stream=True)
+                try:
+                    if response.status_code == 429:
+                        byteloader.upstream_backoff.throttled(f"HTTP 429 from {response.url.host}")
+                        raise SegmentThrottled(f"Upstream throttled bytes {pos}-{end}")
+                    if response.status_code != 206:
+                        raise SegmentError(f"Expected 206 for bytes {pos}-{end}, got {response.status_code}")
+                    if fetcher.min_throughput and attempt < fetcher.max_retries:
+                        deadline = fetcher.slow_grace + (end - pos + 1) / fetcher.min_throughput
+                        await asyncio.wait_for(read(response), deadline)
+                    else:
+                        await read(response)
+                finally:
+                    await response.aclose()
+                if received != end - start + 1:
+                    raise SegmentError(f"Short read for bytes {start}-{end}: got {received} bytes")
+                return chunks
+            except SegmentThrottled:
+                raise
+            except (SegmentError, httpx.HTTPError, OSError, asyncio.TimeoutError) as e:
+                attempt += 1
+                if attempt > fetcher.max_retries:
+                    raise SegmentError(f"Giving up on bytes {start}-{end} after {attempt} attempts: {e}") from e
+                await asyncio.sleep(fetcher.retry_delay * 2 ** (attempt - 1))
+
+
+async def iter_segments(fmt, first_response, start, end):
+    """Yield bytes start..end inclusive in order, like SegmentedFetcher.iter_range on the event loop.
+
+    first_response is the open 206 reply for the first segment and is
+    streamed straight through; later segments are fetched concurrently
+    within the same reorder window as the WSGI path.
+    """
+    fetcher = byteloader.segmented_fetcher
+    segments = [
+        (seg_start, min(seg_start + fetcher.segment_size - 1, end))
+        for seg_start in range(start, end + 1, fetcher.segment_size)
+    ]
+    slots = asyncio.Semaphore(fetcher.concurrency)
+    pending = {}
+    next_submit = 1
+
+    def schedule(next_yield):
+        nonlocal next_submit
+        while next_submit < len(segments) and next_submit - next_yield < fetcher.window:
+            pending[next_submit] = asyncio.ensure_future(fetch_segment(fmt, *segments[next_submit], slots))
+            next_submit += 1
+
+    try:
+        schedule(0)
+        seg_start, seg_end = segments[0]
+        received = 0
+        try:
+            async for chunk in first_response.aiter_raw():
+                received += len(chunk)
+                yield chunk
+        except (httpx.HTTPError, OSError):
+            pass
+        if received < seg_end - seg_start + 1:
+            for chunk in await fetch_segment(fmt, seg_start + received, seg_end, slots):
+                yield chunk
+
+        for index in range(1, len(segments)):
+            schedule(index)
+            for chunk in await pending.pop(index):
+                yield chunk
+    finally:
+        for task in pending.values():
+            task.cancel()
+
+
+def upstream_body(fmt, upstream, start, extent):
+    """Return the async body of an opened upstream reply, fetching the rest in segments if it was ranged."""
+    if extent:
+        fetched_to = parse_content_range(upstream.headers['Content-Range'])[1]
+        if fetched_to < extent[0]:
+            return iter_segments(fmt, upstream, start, extent[0])
+    return upstream.aiter_raw()
+
+
+def prepare_cached(path, plan, scope):
+    """Return (status, headers, offset, length) for serving a cached file, as send_file would.
+
+    send_file is asked for an X-Sendfile response, so it works out the
+    ETag, conditional and Range handling from the file's metadata alone
+    without opening it. Raises FileNotFoundError if the file was evicted.
+    """
+    environ = {'REQUEST_METHOD': scope['method']}
+    for key, value in scope['headers']:
+        environ['HTTP_' + key.decode('latin-1').upper().replace('-', '_')] = value.decode('latin-1')
+    try:
+        response = send_file(
+            path, environ, mimetype=plan['mimetype'], as_attachment=True, download_name=plan['download_name'],
+            conditional=True, use_x_sendfile=True
+        )
+    except RequestedRangeNotSatisfiable as e:
+        return 416, {'Content-Range': f'bytes */{e.length}'}, 0, 0
+    del response.headers['X-Sendfile']
+    content_range = parse_content_range(response.headers.get('Content-Range'))
+    offset = content_range[0] if content_range else 0
+    length = 0 if response.status_code == 304 else response.content_length or 0
+    return response.status_code, dict(response.headers), offset, length
+
+
+async def send_cached(scope, receive, send, path, plan):
+    """Serve a complete file from the content cache without tying up a thread for the transfer."""
+    status, headers, offset, length = await run_in(disk_executor, prepare_cached, path, plan, scope)
+    f = await run_in(disk_executor, open, path, 'rb') if length else None
+    byteloader.requests_total.inc(endpoint='download', outcome='cached')
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.lower().encode(), v.encode('latin-1')) for k, v in headers.items()],
+        })
+        end = offset + length
+        while offset < end and not disconnected.done():
+            chunk = await run_in(disk_executor, os.pread, f.fileno(), min(CACHE_READ_SIZE, end - offset), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        if f is not None:
+            await run_in(disk_executor, f.close)
+
+
+async def wait_for_disconnect(receive):
+    """Return once the client has gone away."""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def download(scope, receive, send):
+    """Async /download for formats proxied as-is; anything else is handed to Flask."""
+    body = await read_body(receive) if scope['method'] == 'POST' else b''
+
+    async def fallback():
+        return await flask_app(scope, replay(body, receive), send)
+
+    try:
+        if scope['method'] == 'POST':
+            data = json.loads(body or b'null')
+        else:
+            data = {k: v[0] for k, v in parse_qs(scope.get('query_string', b'').decode()).items()}
+        url = (data.get('url') or '').strip()
+        extract_audio = byteloader.parse_flag(data.get('extract_audio', False))
+        if not url or not byteloader.is_valid_youtube_url(url):
+            return await fallback()
+
+        video_id = byteloader.get_video_id(url)
+        bind_log_context(video_id=video_id, format_id=data.get('format_id', 'best'))
+        # A handle or cached metadata answers on the loop, without queueing behind extractions
+        info = (byteloader.resolve_download_handle(data.get('handle'), video_id)
+                or byteloader.metadata_cache.peek(byteloader.get_video_id(byteloader.clean_youtube_url(url))))
+        if info is None:
+            info = await coalesce(('info', video_id), byteloader.load_video_info, url)
+        plan = byteloader.plan_download(
+            video_id, info, data.get('format_id', 'best'), extract_audio, data.get('audio_format', 'mp3')
+        )
+        bind_log_context(format_id=plan['fmt']['format_id'])
+    except Overloaded as e:
+        return await send_overloaded(send, e, 'download')
+    except Exception:
+        # Let the Flask route produce its usual error response
+        return await fallback()
+
+    cache = byteloader.content_cache
+    if cache.pending(plan['cache_name']):
+        # Following a fill blocks on its writer, so that stays on a Flask thread
+        return await fallback()
+    cached_path = cache.lookup(plan['cache_name']) if cache.contains(plan['cache_name']) else None
+    if cached_path:
+        try:
+            return await send_cached(scope, receive, send, cached_path, plan)
+        except FileNotFoundError:
+            # Evicted since the lookup; Flask fetches it again
+            return await fallback()
+    if plan['kind'] != 'direct':
+        return await fallback()
+
+    headers = dict(scope['headers'])
+    range_header = headers.get(b'range')
+    byte_range = byteloader.parse_byte_range(range_header.decode('latin-1') if range_header else None, plan['fmt'])
+
+    # Waiting for a slot blocks, so do it off the event loop
+    acquiring = asyncio.ensure_future(run_in(admission_executor, byteloader.stream_limiter.acquire))
+    try:
+        await asyncio.shield(acquiring)
+    except Overloaded as e:
+        return await send_overloaded(send, e, 'download')
+    except asyncio.CancelledError:
+        # The thread may still get a slot after we stop waiting; hand it straight back
+        acquiring.add_done_callback(
+            lambda task: task.exception() is None and byteloader.stream_limiter.release()
+        )
+        raise
+    try:
+        await stream(receive, send, url, video_id, plan, byte_range)
+    finally:
+        byteloader.stream_limiter.release()
+
+
+async def stream(receive, send, url, video_id, plan, byte_range):
+    """Proxy a direct format to the client while holding a stream slot."""
+    start, end = byte_range or (0, None)
+    segmented = byteloader.is_segmented(plan['fmt'], start, end)
+    try:
+        upstream = await open_upstream(plan['fmt'], byte_range, segmented)
+        if upstream.status_code == 403:
+            await upstream.aclose()
+            logger.info(f"Direct URL rejected for {video_id}, re-extracting")
+            byteloader.metadata_cache.invalidate(video_id)
+            info = await coalesce(('info', video_id), byteloader.load_video_info, url)
+            # Same format as before, so a resumed range and the cache name still match
+            plan = {**plan, 'fmt': plan['pick'](info)}
+            upstream = await open_upstream(plan['fmt'], byte_range, segmented)
+    except Overloaded as e:
+        return await send_overloaded(send, e, 'download')
+    except Exception as e:
+        logger.error(f"Upstream error for {video_id}: {str(e)}")
+        return await send_json(send, {'success': False, 'message': f'Error downloading video: {str(e)}'}, 400)
+
+    if upstream.status_code == 429:
+        await upstream.aclose()
+        byteloader.upstream_backoff.throttled(f"HTTP 429 from {upstream.url.host}")
+        e = Overloaded("YouTube is rate limiting downloads", byteloader.upstream_backoff.cooldown())
+        return await send_overloaded(send, e, 'download')
+
+    extent = byteloader.upstream_extent(upstream, start, end)
+    if upstream.status_code == 416 or (extent and start > extent[0]):
+        await upstream.aclose()
+        size = extent[1] if extent else plan['fmt'].get('filesize')
+        await send({
+            'type': 'http.response.start',
+            'status': 416,
+            'headers': [(b'content-range', f'bytes */{size}'.encode())] if size else [],
+        })
+        return await send({'type': 'http.response.body', 'body': b''})
+
+    if upstream.status_code >= 400:
+        await upstream.aclose()
+        return await send_json(send, {
+            'success': False,
+            'message': f'Error downloading video: upstream returned {upstream.status_code}'
+        }, 400)
+
+    status = 200
+    response_headers = {
+        'Content-Type': plan['mimetype'],
+        'Content-Disposition': byteloader.content_disposition(plan['download_name']),
+        'Accept-Ranges': 'bytes',
+    }
+    if extent:
+        last, total = extent
+        response_headers['Content-Length'] = str(last - start + 1)
+        if byte_range:
+            status = 206
+            response_headers['Content-Range'] = f'bytes {start}-{last}/{total}'
+    else:
+        if upstream.headers.get('Content-Length'):
+            response_headers['Content-Length'] = upstream.headers['Content-Length']
+        if upstream.status_code == 206 and byte_range:
+            status = 206
+            response_headers['Content-Range'] = upstream.headers.get('Content-Range')
+
+    fill = None
+    body = upstream_body(plan['fmt'], upstream, start, extent)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    started = mark = time.perf_counter()
+    sent = 0
+    upstream_seconds = client_seconds = 0.0
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.lower().encode(), v.encode('latin-1')) for k, v in response_headers.items()],
+        })
+        byteloader.requests_total.inc(endpoint='download', outcome='ok')
+
+        # Whole-file transfers populate the content cache just like the WSGI path.
+        # The fill starts only once the response has, so every failure from
+        # here on reaches the handlers below that abort it.
+        if not byte_range:
+            expected_size = int(response_headers['Content-Length']) if 'Content-Length' in response_headers else None
+            fill = byteloader.content_cache.begin(plan['cache_name'], expected_size)
+
+        async for chunk in body:
+            now = time.perf_counter()
+            upstream_seconds += now - mark
+            if fill:
+                # Disk writes happen off the event loop; one that fails only stops caching
+                if not await run_in(disk_executor, byteloader.content_cache.write, plan['cache_name'], fill, chunk):
+                    fill = None
+            if disconnected.done():
+                if fill and fill.readers:
+                    # Others are following this fill; finish it without a client
+                    continue
+                raise ConnectionResetError("Client disconnected")
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            sent += len(chunk)
+            mark = time.perf_counter()
+            client_seconds += mark - now
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b''})
+        if fill:
+            await run_in(disk_executor, byteloader.content_cache.complete, plan['cache_name'], fill)
+    except ConnectionResetError:
+        if fill:
+            await run_in(disk_executor, byteloader.content_cache.abort, plan['cache_name'], fill)
+    except BaseException as e:
+        if fill:
+            byteloader.content_cache.abort(plan['cache_name'], fill)
+        if not isinstance(e, asyncio.CancelledError):
+            logger.error(f"Streaming error for {video_id}: {str(e)}")
+        raise
+    finally:
+        disconnected.cancel()
+        await body.aclose()
+        await upstream.aclose()
+        byteloader.record_stream('direct', time.perf_counter() - started, sent, upstream_seconds, client_seconds)
+
+
+async def lifespan(receive, send):
+    """Handle server startup and shutdown, closing the upstream client on exit."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _client is not None:
+                await _client.aclose()
+            for executor in (extraction_executor, admission_executor, disk_executor):
+                executor.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def with_request_id(scope, send):
+    """Bind a request ID for logging and echo it in the X-Request-ID response header.
+
+    The ID is also written into the request headers so a Flask fallback
+    reuses it instead of minting its own.
+    """
+    headers = [(k, v) for k, v in scope['headers'] if k != b'x-request-id']
+    request_id = dict(scope['headers']).get(b'x-request-id', b'').decode('latin-1')
+    if not re.fullmatch(r'[\w.-]{1,64}', request_id):
+        request_id = uuid.uuid4().hex[:16]
+    clear_log_context()
+    bind_log_context(request_id=request_id)
+    scope = {**scope, 'headers': headers + [(b'x-request-id', request_id.encode())]}
+
+    async def send_with_id(message):
+        if message['type'] == 'http.response.start':
+            response_headers = list(message.get('headers', []))
+            if not any(k.lower() == b'x-request-id' for k, _ in response_headers):
+                response_headers.append((b'x-request-id', request_id.encode()))
+            message = {**message, 'headers': response_headers}
+        await send(message)
+
+    return scope, send_with_id
+
+
+async def application(scope, receive, send):
+    """ASGI application: async /preview and /download, Flask for everything else."""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http':
+        scope, send = with_request_id(scope, send)
+        if scope['path'] == '/preview' and scope['method'] == 'POST':
+            return await preview(scope, receive, send)
+        if scope['path'] == '/download' and scope['method'] in ('GET', 'POST'):
+            return await download(scope, receive, send)
+    return await flask_app(scope, receive, send)
@@ -0,0 +1,32 @@
+"""Run ByteLoader through serve.py with the fake extractor installed.
+
+Started as a subprocess by loadtest.py so that its CPU time and memory
+can be measured apart from the load generator. Server settings come from
+the usual environment variables (SERVER_MODE, HOST, PORT, ...).
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_extractor  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--upstream', required=True, help='Base URL of the fake upstream')
+    parser.add_argument('--file-size', type=int, required=True)
+    parser.add_argument('--extract-latency', type=float, default=0.0)
+    parser.add_argument('--extract-jitter', type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake_extractor.install(args.upstream, args.file_size, args.extract_latency, args.extract_jitter)
+
+    # gunicorn forks its workers after this, so they inherit the patched extractor
+    import serve
+    serve.SERVERS[serve.SERVER_MODE]()
+
+
+if __name__ == '__main__':
+    main()
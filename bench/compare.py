@@ -0,0 +1,63 @@
+"""Compare two loadtest.py result files.
+
+    python bench/compare.py bench/results/before.json bench/results/after.json
+
+Prints each scenario and concurrency level found in both runs with the
+change in latency, throughput, CPU and memory.
+"""
+import argparse
+import json
+
+# (label, getter, True if lower is better)
+FIELDS = (
+    ('p50 ms', lambda r: (r['latency_ms'] or {}).get('p50'), True),
+    ('p99 ms', lambda r: (r['latency_ms'] or {}).get('p99'), True),
+    ('ttfb p50 ms', lambda r: (r['ttfb_ms'] or {}).get('p50'), True),
+    ('req/s', lambda r: r['requests_per_s'], False),
+    ('MiB/s', lambda r: r['throughput_mib_s'], False),
+    ('cpu ms/req', lambda r: r.get('cpu_ms_per_request'), True),
+    ('cpu s/GiB', lambda r: r['cpu_seconds_per_gib'], True),
+    ('rss MiB', lambda r: r['rss_peak_mib'], True),
+    ('errors', lambda r: r['errors'], True),
+)
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report, {(r['scenario'], r['concurrency']): r for r in report['results']}
+
+
+def change(before, after, lower_is_better):
+    """Format after relative to before, marking regressions with '!'."""
+    if before is None or after is None or before == after:
+        return f'{after}'
+    if not before:
+        return f'{after} (was {before})'
+    pct = (after - before) / before * 100
+    worse = pct > 0 if lower_is_better else pct < 0
+    return f'{after} ({pct:+.1f}%{"!" if worse and abs(pct) >= 5 else ""})'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args(argv)
+
+    before_report, before = load(args.before)
+    after_report, after = load(args.after)
+    print(f"before: {before_report.get('git_commit')} {before_report['started_at']}")
+    print(f"after:  {after_report.get('git_commit')} {after_report['started_at']}")
+
+    for key in sorted(set(before) & set(after)):
+        print(f'\n{key[0]} c={key[1]}')
+        for label, get, lower_is_better in FIELDS:
+            print(f'  {label:>12}: {get(before[key])} -> {change(get(before[key]), get(after[key]), lower_is_better)}')
+
+    for key in sorted(set(before) ^ set(after)):
+        print(f"\n{key[0]} c={key[1]}: only in {'before' if key in before else 'after'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Canned yt-dlp extraction results pointing at a FakeUpstream."""
+import random
+import re
+import time
+
+import yt_dlp
+
+AUDIO_SIZE_RATIO = 0.1
+
+
+def canned_info(base_url, video_id, file_size):
+    """Return extract_info-shaped metadata whose formats live under base_url.
+
+    Format 18 is progressive, 137/136 are video-only DASH and 140/251 are
+    audio-only, mirroring the mix a real extraction returns.
+    """
+    expire = int(time.time() + 6 * 3600)
+    audio_size = max(1, int(file_size * AUDIO_SIZE_RATIO))
+
+    def url(format_id, size):
+        return f'{base_url}/videoplayback?id={video_id}&itag={format_id}&clen={size}&expire={expire}'
+
+    def fmt(format_id, ext, vcodec, acodec, size, **extra):
+        return {
+            'format_id': format_id, 'ext': ext, 'vcodec': vcodec, 'acodec': acodec,
+            'filesize': size, 'protocol': 'https', 'url': url(format_id, size), **extra,
+        }
+
+    return {
+        'id': video_id,
+        'title': f'Benchmark video {video_id}',
+        'uploader': 'bench',
+        'thumbnail': f'{base_url}/vi/{video_id}/hqdefault.jpg',
+        'duration': 300,
+        'view_count': 0,
+        'formats': [
+            fmt('18', 'mp4', 'avc1.42001E', 'mp4a.40.2', file_size, height=360, width=640, tbr=700, resolution='640x360'),
+            fmt('136', 'mp4', 'avc1.4d401f', 'none', file_size, height=720, width=1280, tbr=2000, resolution='1280x720'),
+            fmt('137', 'mp4', 'avc1.640028', 'none', file_size * 2, height=1080, width=1920, tbr=4000, resolution='1920x1080'),
+            fmt('140', 'm4a', 'none', 'mp4a.40.2', audio_size, abr=128, tbr=128),
+            fmt('251', 'webm', 'none', 'opus', audio_size, abr=160, tbr=160),
+        ],
+    }
+
+
+def install(base_url, file_size, latency=0.0, jitter=0.0, seed=0):
+    """Replace YoutubeDL.extract_info with a fake that sleeps for latency (+ up to jitter) seconds."""
+    rng = random.Random(seed)
+
+    def extract_info(self, url, download=False, **kwargs):
+        time.sleep(latency + (rng.uniform(0, jitter) if jitter else 0))
+        match = re.search(r'(?:v=|youtu\.be/)([\w-]{11})', url)
+        return canned_info(base_url, match.group(1) if match else 'benchvideo0', file_size)
+
+    yt_dlp.YoutubeDL.extract_info = extract_info
@@ -0,0 +1,187 @@
+"""Local stand-in for googlevideo that serves synthetic media bytes.
+
+File sizes come from the clen query parameter, as on real direct URLs,
+so any size can be requested without storing anything. Bandwidth can be
+capped per connection and in total, and a fraction of requests can be
+answered with errors, 429s or bodies cut short.
+"""
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# Repeating 1 MiB pattern that every synthetic file is cut from
+BLOCK = bytes(range(256)) * 4096
+WRITE_SIZE = 64 * 1024
+
+
+def synthetic_bytes(start, end, chunk_size=WRITE_SIZE):
+    """Yield the bytes at offsets start..end inclusive of a synthetic file."""
+    pos = start
+    while pos <= end:
+        offset = pos % len(BLOCK)
+        size = min(chunk_size, end - pos + 1, len(BLOCK) - offset)
+        yield BLOCK[offset:offset + size]
+        pos += size
+
+
+class TokenBucket:
+    """Shared bandwidth limit in bytes per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """Block until amount bytes may be sent."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class FakeUpstream:
+    """Threaded HTTP server imitating googlevideo's Range-capable direct URLs."""
+
+    def __init__(self, host='127.0.0.1', port=0, connection_bandwidth=None, total_bandwidth=None,
+                 latency=0.0, error_rate=0.0, error_status=503, throttle_rate=0.0, truncate_rate=0.0, seed=0):
+        self.connection_bandwidth = connection_bandwidth
+        self.total_bucket = TokenBucket(total_bandwidth) if total_bandwidth else None
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.throttle_rate = throttle_rate
+        self.truncate_rate = truncate_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes': 0, 'errors': 0, 'throttled': 0, 'truncated': 0}
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def url_for(self, video_id, format_id, size, expires_in=6 * 3600):
+        """Return a direct URL for a synthetic file of size bytes."""
+        query = urlencode({'id': video_id, 'itag': format_id, 'clen': size, 'expire': int(time.time() + expires_in)})
+        return f'{self.base_url}/videoplayback?{query}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-upstream', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def _roll(self, rate):
+        if not rate:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def _send(self, wfile, chunks, limit=None):
+        """Write chunks with bandwidth limits applied, stopping after limit bytes if given."""
+        sent = 0
+        started = time.monotonic()
+        for chunk in chunks:
+            if limit is not None and sent + len(chunk) > limit:
+                chunk = chunk[:limit - sent]
+            if self.total_bucket:
+                self.total_bucket.consume(len(chunk))
+            wfile.write(chunk)
+            sent += len(chunk)
+            self._count('bytes', len(chunk))
+            if self.connection_bandwidth:
+                ahead = sent / self.connection_bandwidth - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+            if limit is not None and sent >= limit:
+                return
+
+    def _handler_class(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                self.do_GET(body=False)
+
+            def do_GET(self, body=True):
+                upstream._count('requests')
+                if upstream.latency:
+                    time.sleep(upstream.latency)
+
+                query = parse_qs(urlparse(self.path).query)
+                if 'clen' not in query:
+                    return self._empty(404)
+                if upstream._roll(upstream.throttle_rate):
+                    upstream._count('throttled')
+                    return self._empty(429)
+                if upstream._roll(upstream.error_rate):
+                    upstream._count('errors')
+                    return self._empty(upstream.error_status)
+
+                size = int(query['clen'][0])
+                start, end, status = 0, size - 1, 200
+                range_header = self.headers.get('Range')
+                if range_header and range_header.startswith('bytes='):
+                    first, _, last = range_header[6:].partition('-')
+                    if first:
+                        start = int(first)
+                        end = min(int(last), size - 1) if last else size - 1
+                    else:
+                        start = max(0, size - int(last))
+                    if start >= size:
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{size}')
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    status = 206
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'video/mp4')
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Length', str(end - start + 1))
+                if status == 206:
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                self.end_headers()
+                if not body:
+                    return
+
+                limit = None
+                if upstream._roll(upstream.truncate_rate):
+                    upstream._count('truncated')
+                    limit = (end - start + 1) // 2
+                    self.close_connection = True
+                try:
+                    upstream._send(self.wfile, synthetic_bytes(start, end), limit)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+
+            def _empty(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        return Handler
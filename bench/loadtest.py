@@ -0,0 +1,395 @@
+"""Offline load test for /preview and /download.
+
+    python bench/loadtest.py --scenarios preview download --concurrency 1 8 32
+
+A FakeUpstream stands in for googlevideo and the app runs in a
+subprocess with the fake extractor installed, so nothing touches the
+network. Each scenario is run at every concurrency level and the results
+(latency percentiles, throughput, and the app's CPU time and RSS) are
+written as JSON that bench/compare.py can diff between runs.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+from fake_upstream import FakeUpstream
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCENARIOS = ('preview', 'download', 'download-cached', 'download-range')
+RSS_SAMPLE_INTERVAL = 0.1
+READ_SIZE = 256 * 1024
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PROCESS_ERRORS = (OSError, ValueError) + ((psutil.Error,) if psutil is not None else ())
+
+
+class ProcessTree:
+    """CPU time and RSS of a process and all of its descendants (gunicorn master plus workers)."""
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def _pids(self):
+        if psutil is not None:
+            root = psutil.Process(self.pid)
+            return [root.pid] + [child.pid for child in root.children(recursive=True)]
+        parents = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as f:
+                        parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+        pids = [self.pid]
+        for pid in pids:
+            pids.extend(child for child, parent in parents.items() if parent == pid)
+        return pids
+
+    def cpu_seconds(self):
+        total = 0.0
+        for pid in self._pids():
+            try:
+                if psutil is not None:
+                    times = psutil.Process(pid).cpu_times()
+                    total += times.user + times.system
+                else:
+                    with open(f'/proc/{pid}/stat') as f:
+                        fields = f.read().rsplit(')', 1)[1].split()
+                    total += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            except PROCESS_ERRORS:
+                continue
+        return total
+
+    def rss_bytes(self):
+        total = 0
+        for pid in self._pids():
+            try:
+                if psutil is not None:
+                    total += psutil.Process(pid).memory_info().rss
+                else:
+                    with open(f'/proc/{pid}/status') as f:
+                        for line in f:
+                            if line.startswith('VmRSS:'):
+                                total += int(line.split()[1]) * 1024
+            except PROCESS_ERRORS:
+                continue
+        return total
+
+
+class RssSampler:
+    """Records the peak RSS of a process tree in a background thread."""
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.tree.rss_bytes())
+            self._stop.wait(RSS_SAMPLE_INTERVAL)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.tree.rss_bytes())
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def summarize(values):
+    """Return p50/p90/p99/max/mean of a list of seconds, in milliseconds."""
+    if not values:
+        return None
+    return {
+        'p50': round(percentile(values, 50) * 1000, 2),
+        'p90': round(percentile(values, 90) * 1000, 2),
+        'p99': round(percentile(values, 99) * 1000, 2),
+        'max': round(max(values) * 1000, 2),
+        'mean': round(sum(values) / len(values) * 1000, 2),
+    }
+
+
+def video_url(n):
+    """Return a watch URL with a distinct, valid-looking 11-character video ID."""
+    return f'https://www.youtube.com/watch?v=bench{n:06d}'
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.base_url = f'http://127.0.0.1:{args.port}'
+        self._local = threading.local()
+        self._video_counter = 0
+        self._counter_lock = threading.Lock()
+
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def next_video(self):
+        """Return a video URL; distinct per request unless --distinct-videos limits the pool."""
+        with self._counter_lock:
+            self._video_counter += 1
+            n = self._video_counter
+        if self.args.distinct_videos:
+            n %= self.args.distinct_videos
+        return video_url(n)
+
+    def preview(self):
+        started = time.perf_counter()
+        response = self.session().post(f'{self.base_url}/preview', json={'url': self.next_video()}, timeout=120)
+        body = response.content
+        elapsed = time.perf_counter() - started
+        return {'status': response.status_code, 'latency': elapsed, 'ttfb': None, 'bytes': len(body)}
+
+    def download(self, url=None, headers=None):
+        started = time.perf_counter()
+        response = self.session().get(
+            f'{self.base_url}/download',
+            params={'url': url or self.next_video(), 'format_id': self.args.format_id},
+            headers=headers,
+            stream=True,
+            timeout=120
+        )
+        ttfb = None
+        size = 0
+        try:
+            for chunk in response.iter_content(READ_SIZE):
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+                size += len(chunk)
+        finally:
+            response.close()
+        elapsed = time.perf_counter() - started
+        return {'status': response.status_code, 'latency': elapsed, 'ttfb': ttfb, 'bytes': size}
+
+    def request_for(self, scenario):
+        if scenario == 'preview':
+            return self.preview
+        if scenario == 'download':
+            return self.download
+        if scenario == 'download-cached':
+            return lambda: self.download(video_url(0))
+        if scenario == 'download-range':
+            # Seek-like ranged reads at random-looking offsets within the file
+            def ranged():
+                with self._counter_lock:
+                    self._video_counter += 1
+                    offset = (self._video_counter * 7919 * 1024) % max(1, self.args.file_size - self.args.range_size)
+                return self.download(
+                    video_url(0), {'Range': f'bytes={offset}-{offset + self.args.range_size - 1}'}
+                )
+            return ranged
+        raise ValueError(f'Unknown scenario {scenario}')
+
+    def run(self, scenario, concurrency, tree):
+        requests_count = self.args.requests
+        request = self.request_for(scenario)
+        if scenario in ('download-cached', 'download-range'):
+            # Warm the content cache so these measure serving from disk
+            self.download(video_url(0))
+
+        results = []
+        errors = []
+
+        def one(_):
+            try:
+                results.append(request())
+            except requests.RequestException as e:
+                errors.append(type(e).__name__)
+
+        cpu_before = tree.cpu_seconds()
+        with RssSampler(tree) as rss:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(one, range(requests_count)))
+            duration = time.perf_counter() - started
+        cpu = tree.cpu_seconds() - cpu_before
+
+        ok = [r for r in results if r['status'] < 400]
+        total_bytes = sum(r['bytes'] for r in ok)
+        statuses = {}
+        for r in results:
+            statuses[str(r['status'])] = statuses.get(str(r['status']), 0) + 1
+        for name in errors:
+            statuses[name] = statuses.get(name, 0) + 1
+
+        return {
+            'scenario': scenario,
+            'concurrency': concurrency,
+            'requests': requests_count,
+            'ok': len(ok),
+            'errors': requests_count - len(ok),
+            'statuses': statuses,
+            'duration_s': round(duration, 3),
+            'requests_per_s': round(len(ok) / duration, 2) if duration else None,
+            'latency_ms': summarize([r['latency'] for r in ok]),
+            'ttfb_ms': summarize([r['ttfb'] for r in ok if r['ttfb'] is not None]),
+            'bytes': total_bytes,
+            'throughput_mib_s': round(total_bytes / duration / 2 ** 20, 2) if duration else None,
+            'cpu_seconds': round(cpu, 3),
+            'cpu_ms_per_request': round(cpu / len(ok) * 1000, 2) if ok else None,
+            'cpu_seconds_per_gib': (
+                round(cpu / (total_bytes / 2 ** 30), 3) if total_bytes and scenario.startswith('download') else None
+            ),
+            'rss_peak_mib': round(rss.peak / 2 ** 20, 1),
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_app(args, upstream, workdir):
+    """Start the app subprocess and wait until it answers."""
+    env = dict(
+        os.environ,
+        SERVER_MODE=args.server,
+        HOST='127.0.0.1',
+        PORT=str(args.port),
+        DEBUG='false',
+        DOWNLOAD_FOLDER=os.path.join(workdir, 'downloads'),
+        CONTENT_CACHE_MAX_BYTES=str(args.cache_bytes),
+        SECRET_KEY='bench',
+    )
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, 'app_server.py'),
+         '--upstream', upstream.base_url,
+         '--file-size', str(args.file_size),
+         '--extract-latency', str(args.extract_latency),
+         '--extract-jitter', str(args.extract_jitter)],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=open(os.path.join(workdir, 'server.log'), 'wb')
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'App exited with {process.returncode}; see {workdir}/server.log')
+        try:
+            requests.get(f'http://127.0.0.1:{args.port}/stats', timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('App did not start within 30 seconds')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=['preview', 'download'])
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=64, help='Requests per scenario and concurrency level')
+    parser.add_argument('--server', choices=('wsgi', 'asgi', 'dev'), default='wsgi')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--format-id', default='18')
+    parser.add_argument('--file-size', type=int, default=16 * 2 ** 20, help='Bytes per synthetic file')
+    parser.add_argument('--range-size', type=int, default=2 ** 20, help='Bytes per download-range request')
+    parser.add_argument('--distinct-videos', type=int, default=0,
+                        help='Cycle through this many video IDs (0: a new ID per request, so every request misses the caches)')
+    parser.add_argument('--cache-bytes', type=int, default=2 ** 30, help='Content cache quota for the app under test')
+    parser.add_argument('--extract-latency', type=float, default=0.2, help='Seconds each fake extraction takes')
+    parser.add_argument('--extract-jitter', type=float, default=0.0)
+    parser.add_argument('--connection-bandwidth', type=float, default=None, help='Upstream bytes/s per connection')
+    parser.add_argument('--total-bandwidth', type=float, default=None, help='Upstream bytes/s across all connections')
+    parser.add_argument('--upstream-latency', type=float, default=0.0, help='Seconds before each upstream reply')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of upstream requests failed')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of upstream requests answered 429')
+    parser.add_argument('--truncate-rate', type=float, default=0.0, help='Fraction of upstream bodies cut short')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Results file (default: bench/results/<timestamp>.json)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    upstream = FakeUpstream(
+        connection_bandwidth=args.connection_bandwidth,
+        total_bandwidth=args.total_bandwidth,
+        latency=args.upstream_latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        throttle_rate=args.throttle_rate,
+        truncate_rate=args.truncate_rate,
+        seed=args.seed
+    ).start()
+
+    started_at = datetime.now(timezone.utc)
+    results = []
+    with tempfile.TemporaryDirectory(prefix='byteloader-bench-') as workdir:
+        process = start_app(args, upstream, workdir)
+        try:
+            tree = ProcessTree(process.pid)
+            loadtest = LoadTest(args)
+            for scenario in args.scenarios:
+                for concurrency in args.concurrency:
+                    result = loadtest.run(scenario, concurrency, tree)
+                    results.append(result)
+                    latency = result['latency_ms'] or {}
+                    print(f"{scenario:>16} c={concurrency:<4} ok={result['ok']:<5} "
+                          f"p50={latency.get('p50')}ms p99={latency.get('p99')}ms "
+                          f"{result['throughput_mib_s']} MiB/s cpu ms/req={result['cpu_ms_per_request']} "
+                          f"cpu s/GiB={result['cpu_seconds_per_gib']} "
+                          f"rss={result['rss_peak_mib']} MiB", flush=True)
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    upstream.stop()
+
+    report = {
+        'started_at': started_at.isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'upstream': upstream.stats,
+        'results': results,
+    }
+    output = args.output or os.path.join(BENCH_DIR, 'results', started_at.strftime('%Y%m%dT%H%M%SZ') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+PART_SUFFIX = '.part'
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class ContentCacheError(Exception):
+    """Raised to readers of a fill that was abandoned before it completed."""
+
+
+class _Fill:
+    """A cache file that is still being written by its first requester."""
+
+    def __init__(self, part_path, final_path, expected_size=None):
+        self.part_path = part_path
+        self.final_path = final_path
+        self.expected_size = expected_size
+        self.size = 0
+        self.readers = 0
+        self.done = False
+        self.failed = False
+        self.file = None
+        self.cond = threading.Condition()
+
+
+class ContentCache:
+    """On-disk cache of complete media files with a byte quota and LRU eviction.
+
+    The first request for a file tees upstream bytes into a temporary part
+    file while streaming them to its client. Requests that arrive before
+    the fill finishes follow the part file as it grows, and later requests
+    are served straight from disk once the file has been promoted.
+    """
+
+    def __init__(self, folder, max_bytes, sweep_interval=60, part_max_age=3600):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.part_max_age = part_max_age
+        self._index = OrderedDict()  # filename -> size, least recently used first
+        self._fills = {}
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(folder, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """Index complete files already on disk, oldest access first."""
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and not entry.name.endswith(PART_SUFFIX):
+                stat = entry.stat()
+                entries.append((max(stat.st_atime, stat.st_mtime), entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+
+    @staticmethod
+    def filename(video_id, format_id, ext):
+        """Return the cache file name for a (video_id, format_id) pair."""
+        name = f"{video_id}-{format_id}.{ext}"
+        return re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+
+    def path(self, name):
+        """Return the absolute path of a cache file."""
+        return os.path.join(self.folder, name)
+
+    def lookup(self, name):
+        """Return the path of a complete cached file and mark it recently used, or None."""
+        with self._lock:
+            if name in self._index and os.path.exists(self.path(name)):
+                self._index.move_to_end(name)
+                self.hits += 1
+                return self.path(name)
+            self._index.pop(name, None)
+            self.misses += 1
+            return None
+
+    def contains(self, name):
+        """Return True if name is cached or being filled, without touching counters."""
+        with self._lock:
+            return name in self._fills or (name in self._index and os.path.exists(self.path(name)))
+
+    def pending(self, name):
+        """Return the in-progress fill for name, or None."""
+        with self._lock:
+            return self._fills.get(name)
+
+    def _reserved(self):
+        """Return the bytes claimed by fills in progress. Caller holds _lock."""
+        return sum(max(fill.expected_size or 0, fill.size) for fill in self._fills.values())
+
+    def _refuse(self, name, expected_size):
+        """Return True if name is already being filled or expected_size cannot fit. Caller holds _lock."""
+        if name in self._fills:
+            return True
+        return expected_size is not None and self._reserved() + expected_size > self.max_bytes
+
+    def has_room(self, size):
+        """Return True if a fill of size bytes fits in the quota alongside the fills in progress."""
+        with self._lock:
+            return self._reserved() + size <= self.max_bytes
+
+    def begin(self, name, expected_size=None):
+        """Start filling name and return the fill, or None if it should not be cached now.
+
+        That is when another request is already filling it, or when its
+        expected size does not fit in the quota alongside the fills in
+        progress. Room for the expected size is made by evicting before
+        the fill starts, not after it is written.
+        """
+        with self._lock:
+            if self._refuse(name, expected_size):
+                return None
+        if expected_size is not None:
+            self.enforce_quota(expected_size)
+        with self._lock:
+            if self._refuse(name, expected_size):
+                return None
+            part_path = self.path(f"{name}.{uuid.uuid4().hex}{PART_SUFFIX}")
+            fill = _Fill(part_path, self.path(name), expected_size)
+            fill.file = open(part_path, 'wb')
+            self._fills[name] = fill
+            return fill
+
+    def tee(self, name, chunks, expected_size=None):
+        """Yield chunks unchanged while writing them to the cache.
+
+        The file is only promoted into the cache once every chunk has been
+        written (and, if known, the size matches). If the client goes away
+        while others are following the fill, the rest is drained in the
+        background so those readers still get the whole file. The cache is
+        only an optimisation: if writing fails, the fill is abandoned and
+        the chunks keep flowing to the client.
+        """
+        fill = self.begin(name, expected_size)
+        chunks = iter(chunks)
+        try:
+            for chunk in chunks:
+                if fill is not None and not self.write(name, fill, chunk):
+                    fill = None
+                yield chunk
+        except GeneratorExit:
+            if fill is not None and fill.readers:
+                threading.Thread(target=self._drain, args=(name, fill, chunks), daemon=True).start()
+            else:
+                if fill is not None:
+                    self.abort(name, fill)
+                close = getattr(chunks, 'close', None)
+                if close:
+                    close()
+            raise
+        except BaseException:
+            if fill is not None:
+                self.abort(name, fill)
+            raise
+        if fill is not None:
+            self.complete(name, fill)
+
+    def append(self, fill, chunk):
+        """Write a chunk to a fill and wake its followers."""
+        fill.file.write(chunk)
+        fill.file.flush()
+        with fill.cond:
+            fill.size += len(chunk)
+            fill.cond.notify_all()
+
+    def write(self, name, fill, chunk):
+        """Append a chunk, abandoning the fill if the write fails; returns False once abandoned."""
+        try:
+            self.append(fill, chunk)
+            return True
+        except Exception as e:
+            logger.error(f"Cache write for {name} failed, no longer caching it: {str(e)}")
+            self.abort(name, fill)
+            return False
+
+    def complete(self, name, fill):
+        """Promote a fill like finish(), abandoning it instead of raising if that fails."""
+        try:
+            self.finish(name, fill)
+        except Exception as e:
+            logger.error(f"Could not promote cache fill for {name}: {str(e)}")
+            self.abort(name, fill)
+
+    def _drain(self, name, fill, chunks):
+        """Finish a fill whose original client disconnected."""
+        try:
+            for chunk in chunks:
+                self.append(fill, chunk)
+        except Exception as e:
+            logger.error(f"Cache fill for {name} failed: {str(e)}")
+            self.abort(name, fill)
+            return
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close:
+                close()
+        self.complete(name, fill)
+
+    def finish(self, name, fill):
+        """Promote a completely written fill into the cache."""
+        fill.file.close()
+        if fill.expected_size is not None and fill.size != fill.expected_size:
+            logger.error(f"Cache fill for {name} ended at {fill.size} of {fill.expected_size} bytes")
+            self.abort(name, fill)
+            return
+        os.replace(fill.part_path, self.path(name))
+        with self._lock:
+            self._index[name] = fill.size
+            self._index.move_to_end(name)
+            self._fills.pop(name, None)
+        with fill.cond:
+            fill.done = True
+            fill.cond.notify_all()
+        self.enforce_quota()
+
+    def abort(self, name, fill):
+        """Discard a fill and fail its followers."""
+        try:
+            fill.file.close()
+        except OSError:
+            # Closing flushes, which fails again if a write just failed
+            pass
+        try:
+            os.remove(fill.part_path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            if self._fills.get(name) is fill:
+                del self._fills[name]
+        with fill.cond:
+            fill.failed = True
+            fill.cond.notify_all()
+
+    def follow(self, fill, timeout=60):
+        """Return an iterator over the contents of an in-progress fill as it is written.
+
+        The reader is registered immediately so the fill is not abandoned
+        if its original client disconnects before iteration starts.
+        """
+        with fill.cond:
+            fill.readers += 1
+        return self._follow(fill, timeout)
+
+    def _follow(self, fill, timeout):
+        try:
+            try:
+                f = open(fill.part_path, 'rb')
+            except FileNotFoundError:
+                # Already promoted (or abandoned) before we got here
+                try:
+                    f = open(fill.final_path, 'rb')
+                except FileNotFoundError:
+                    if fill.failed:
+                        raise ContentCacheError(f"Cache fill {fill.part_path} was abandoned") from None
+                    raise
+            # An open handle keeps reading the same inode after the rename
+            with f:
+                pos = 0
+                while True:
+                    with fill.cond:
+                        while fill.size <= pos and not fill.done and not fill.failed:
+                            if not fill.cond.wait(timeout):
+                                raise ContentCacheError(f"Timed out waiting for {fill.part_path}")
+                        size, done, failed = fill.size, fill.done, fill.failed
+                    if failed:
+                        raise ContentCacheError(f"Cache fill {fill.part_path} was abandoned")
+                    if pos < size:
+                        chunk = f.read(min(size - pos, READ_CHUNK_SIZE))
+                        pos += len(chunk)
+                        yield chunk
+                    elif done:
+                        return
+        finally:
+            with fill.cond:
+                fill.readers -= 1
+
+    def wait(self, fill, timeout=None):
+        """Block until a fill finishes; returns True if it was promoted into the cache."""
+        with fill.cond:
+            fill.cond.wait_for(lambda: fill.done or fill.failed, timeout)
+            return fill.done
+
+    def touch(self, name):
+        """Mark a cached file as recently used."""
+        with self._lock:
+            if name in self._index:
+                self._index.move_to_end(name)
+
+    def enforce_quota(self, extra=0):
+        """Delete least recently used files until they, the fills in progress and extra bytes fit in max_bytes."""
+        while True:
+            with self._lock:
+                total = sum(self._index.values()) + self._reserved() + extra
+                if total <= self.max_bytes or not self._index:
+                    return
+                name, _ = self._index.popitem(last=False)
+                self.evictions += 1
+            try:
+                os.remove(self.path(name))
+                logger.info(f"Evicted {name} from content cache")
+            except FileNotFoundError:
+                pass
+
+    def sweep(self):
+        """Drop vanished entries and stale part files, then enforce the quota."""
+        with self._lock:
+            for name in [n for n in self._index if not os.path.exists(self.path(n))]:
+                del self._index[name]
+            active = {fill.part_path for fill in self._fills.values()}
+        now = time.time()
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(PART_SUFFIX) and entry.path not in active:
+                try:
+                    if now - entry.stat().st_mtime > self.part_max_age:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+        self.enforce_quota()
+
+    def start_sweeper(self):
+        """Run sweep() periodically in a daemon thread."""
+        def run():
+            while True:
+                time.sleep(self.sweep_interval)
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"Content cache sweep failed: {str(e)}")
+
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=run, name='content-cache-sweeper', daemon=True)
+            self._sweeper.start()
+
+    def stats(self):
+        """Return size, quota and hit counters."""
+        with self._lock:
+            return {
+                'files': len(self._index),
+                'bytes': sum(self._index.values()),
+                'max_bytes': self.max_bytes,
+                'filling': len(self._fills),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,254 @@
+import re
+from collections import defaultdict, namedtuple
+
+# Codec families as named in preference specs, most widely playable first
+VIDEO_CODECS = ('h264', 'vp9', 'av1', 'h265')
+AUDIO_CODECS = ('aac', 'opus', 'vorbis', 'mp3')
+CONTAINERS = ('mp4', 'webm', 'm4a', '3gp')
+
+# Audio muxed with video-only formats into MP4, in order of preference
+MUX_AUDIO_CODECS = ('aac', 'opus')
+
+_CODEC_PREFIXES = (
+    ('avc', 'h264'), ('h264', 'h264'),
+    ('vp09', 'vp9'), ('vp9', 'vp9'),
+    ('av01', 'av1'), ('av1', 'av1'),
+    ('hev', 'h265'), ('hvc', 'h265'), ('h265', 'h265'),
+    ('mp4a', 'aac'), ('aac', 'aac'),
+    ('opus', 'opus'), ('vorbis', 'vorbis'), ('mp3', 'mp3'),
+)
+
+# Cache key under which an info dict's index is kept
+INDEX_KEY = '_format_index'
+
+_SIZE_UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+class FormatSpecError(ValueError):
+    """Raised when a preference spec cannot be parsed."""
+
+
+class Preference(namedtuple(
+        'Preference', 'max_height codecs containers order max_size progressive audio_only',
+        defaults=(None, (), (), 'smallest', None, False, False))):
+    """What to download, for FormatIndex.select().
+
+    max_height caps the resolution; the highest resolution under it wins.
+    codecs and containers are tried in order, then order ('smallest' or
+    'largest') breaks ties on estimated transfer size, counting the audio
+    a video-only format would be muxed with. Formats estimated above
+    max_size bytes are skipped. progressive requires video that already
+    carries audio. audio_only selects an audio-only format instead.
+    """
+
+    __slots__ = ()
+
+
+def codec_family(codec):
+    """Return the family of a yt-dlp codec string, e.g. 'avc1.64001F' -> 'h264', or None."""
+    if not codec or codec == 'none':
+        return None
+    codec = codec.lower()
+    for prefix, family in _CODEC_PREFIXES:
+        if codec.startswith(prefix):
+            return family
+    return codec.split('.')[0]
+
+
+def is_direct_format(f):
+    """Return True if a format is a single file we can fetch over plain HTTP(S)."""
+    return bool(f.get('url')) and f.get('protocol', 'https') in ('http', 'https')
+
+
+def parse_preference(spec):
+    """Parse a spec such as '<=1080p, av1>vp9>h264, smallest' into a Preference.
+
+    Comma-separated terms, in any order:
+    - '<=1080p' or '1080p': maximum height
+    - 'av1>vp9>h264': codecs in order of preference
+    - 'mp4' or 'webm>mp4': containers in order of preference
+    - 'smallest' or 'largest': tie-break on estimated size
+    - '<=500MB': skip formats estimated to be larger
+    - 'progressive': only formats that already carry audio
+    - 'audio': an audio-only format
+    """
+    fields = {}
+    for term in (t.strip().lower() for t in spec.split(',')):
+        if not term:
+            continue
+        term = term.replace('≤', '<=')
+        height = re.fullmatch(r'(?:<=)?\s*(\d+)p', term)
+        size = re.fullmatch(r'<=\s*(\d+(?:\.\d+)?)\s*([kmg])i?b', term)
+        if height:
+            fields['max_height'] = int(height.group(1))
+        elif size:
+            fields['max_size'] = int(float(size.group(1)) * _SIZE_UNITS[size.group(2)])
+        elif term in ('smallest', 'largest'):
+            fields['order'] = term
+        elif term == 'progressive':
+            fields['progressive'] = True
+        elif term == 'audio':
+            fields['audio_only'] = True
+        else:
+            names = tuple(re.split(r'\s*>\s*', re.sub(r'^prefer\s+', '', term)))
+            if all(name in VIDEO_CODECS or name in AUDIO_CODECS for name in names):
+                fields['codecs'] = names
+            elif all(name in CONTAINERS for name in names):
+                fields['containers'] = names
+            else:
+                raise FormatSpecError(f"Unrecognised format preference: {term!r}")
+    if not fields:
+        raise FormatSpecError("Empty format preference")
+    return Preference(**fields)
+
+
+class FormatIndex:
+    """The directly fetchable formats of one extraction, indexed for selection.
+
+    Built once per extraction. Video formats are bucketed by height, and
+    every format is also indexed by codec family, with each bucket sorted
+    best first. select() walks heights from the top and memoises its
+    answer per Preference, so repeated choices cost a dict lookup.
+    """
+
+    def __init__(self, formats, duration=None):
+        self.duration = duration or 0
+        self.by_id = {}
+        self.by_height = defaultdict(list)     # height -> video formats
+        self.by_codec = defaultdict(list)   # codec family -> formats
+        self.video = []
+        self.audio = []
+        self._sizes = {}
+        self._choices = {}
+
+        for f in formats:
+            if not is_direct_format(f) or not f.get('format_id'):
+                continue
+            vcodec = codec_family(f.get('vcodec'))
+            acodec = codec_family(f.get('acodec'))
+            if not vcodec and not acodec:
+                continue
+            self.by_id[f['format_id']] = f
+            self._sizes[f['format_id']] = self._estimate_size(f)
+            self.by_codec[vcodec or acodec].append(f)
+            if vcodec:
+                self.video.append(f)
+                self.by_height[f.get('height') or 0].append(f)
+            else:
+                self.audio.append(f)
+
+        def quality(f):
+            return (f.get('height') or 0, f.get('fps') or 0, f.get('abr') or f.get('tbr') or 0)
+
+        for bucket in (self.video, self.audio, *self.by_height.values(), *self.by_codec.values()):
+            bucket.sort(key=quality, reverse=True)
+        self.heights = sorted(self.by_height, reverse=True)
+
+    @classmethod
+    def of(cls, info):
+        """Return the index for an extraction, building and attaching it on first use."""
+        index = info.get(INDEX_KEY)
+        if index is None:
+            index = info[INDEX_KEY] = cls(info.get('formats') or [], info.get('duration'))
+        return index
+
+    def _estimate_size(self, f):
+        """Return a format's size in bytes, estimated from its bitrate when not reported."""
+        size = f.get('filesize') or f.get('filesize_approx')
+        if size:
+            return size
+        if f.get('tbr') and self.duration:
+            return int(f['tbr'] * self.duration * 125)
+        return None
+
+    def size(self, f):
+        """Return the known or estimated size of a format in bytes, or None."""
+        return self._sizes.get(f.get('format_id'))
+
+    def is_progressive(self, f):
+        """Return True if a format carries both video and audio."""
+        return bool(codec_family(f.get('vcodec')) and codec_family(f.get('acodec')))
+
+    def is_audio_only(self, f):
+        """Return True if a format carries audio but no video."""
+        return not codec_family(f.get('vcodec')) and bool(codec_family(f.get('acodec')))
+
+    def best_audio(self, codecs=()):
+        """Return the highest bitrate audio-only format, trying codec families in order first."""
+        for codec in codecs:
+            for f in self.by_codec.get(codec, ()):
+                if self.is_audio_only(f):
+                    return f
+        return self.audio[0] if self.audio else None
+
+    def mux_audio(self, codecs=()):
+        """Return the audio to mux with a video-only format, trying the given codecs MP4 can carry first."""
+        return self.best_audio(tuple(c for c in codecs if c in MUX_AUDIO_CODECS) + MUX_AUDIO_CODECS)
+
+    def select(self, pref):
+        """Return the format best matching a Preference, or None."""
+        if pref not in self._choices:
+            self._choices[pref] = self._audio_choice(pref) if pref.audio_only else self._video_choice(pref)
+        return self._choices[pref]
+
+    def best_pair(self, pref):
+        """Return (format, audio to mux with it) for a Preference; audio is None unless the format is video-only."""
+        video = self.select(pref)
+        if video is None or self.is_progressive(video) or self.is_audio_only(video):
+            return video, None
+        return video, self.mux_audio(pref.codecs)
+
+    def _preference_rank(self, f, pref):
+        """Return where a format's codec and container fall in the preference's orderings."""
+        family = codec_family(f.get('vcodec')) or codec_family(f.get('acodec'))
+        return (
+            pref.codecs.index(family) if family in pref.codecs else len(pref.codecs),
+            pref.containers.index(f.get('ext')) if f.get('ext') in pref.containers else len(pref.containers),
+        )
+
+    def _rank(self, candidates, pref, audio_size=0):
+        """Pick from equally high quality candidates by codec, container, then estimated size."""
+        def key(f):
+            size = self._transfer_size(f, audio_size)
+            unknown = size is None
+            if unknown:
+                size = 0
+            return (*self._preference_rank(f, pref), unknown, size if pref.order == 'smallest' else -size)
+        return min(candidates, key=key, default=None)
+
+    def _transfer_size(self, f, audio_size=0):
+        """Return the bytes fetched to deliver a format, including any muxed audio, or None."""
+        size = self.size(f)
+        if size is None or self.is_progressive(f):
+            return size
+        return size + audio_size
+
+    def _fits(self, f, pref, audio_size=0):
+        """Return False if a format is known to exceed the preference's size cap."""
+        if pref.max_size is None or self.size(f) is None:
+            return True
+        return self._transfer_size(f, audio_size) <= pref.max_size
+
+    def _video_choice(self, pref):
+        audio = None if pref.progressive else self.mux_audio(pref.codecs)
+        audio_size = (self.size(audio) or 0) if audio else 0
+        for height in self.heights:
+            if pref.max_height and height > pref.max_height:
+                continue
+            candidates = [
+                f for f in self.by_height[height]
+                if (self.is_progressive(f) or audio is not None) and self._fits(f, pref, audio_size)
+            ]
+            if candidates:
+                return self._rank(candidates, pref, audio_size)
+        return None
+
+    def _audio_choice(self, pref):
+        candidates = [f for f in self.audio if self._fits(f, pref)]
+        if not candidates:
+            return None
+        # Codec and container preferences come first, then bitrate; size only breaks ties
+        preferred = min(self._preference_rank(f, pref) for f in candidates)
+        candidates = [f for f in candidates if self._preference_rank(f, pref) == preferred]
+        top = candidates[0].get('abr') or candidates[0].get('tbr') or 0
+        return self._rank([f for f in candidates if (f.get('abr') or f.get('tbr') or 0) == top], pref)
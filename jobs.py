@@ -0,0 +1,210 @@
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from limits import Overloaded
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATES = ('done', 'failed', 'partial')
+
+
+class JobQueueFull(Exception):
+    """Raised when too many jobs are already waiting or running."""
+
+
+class Job:
+    """A batch of URLs downloaded in the background, with observable progress."""
+
+    def __init__(self, urls, options):
+        self.id = uuid.uuid4().hex
+        self.options = options
+        self.items = [
+            {'url': url, 'status': 'queued', 'bytes_done': 0, 'bytes_total': None, 'error': None, 'result': None}
+            for url in urls
+        ]
+        self.status = 'queued'
+        self.created = time.time()
+        self.finished = None
+        self.version = 0
+        self.cond = threading.Condition()
+        self._next = 0
+        self._running = 0
+        self._retry = []    # indexes of items to run again ahead of new ones
+        self._waiting = 0   # items sleeping off an Overloaded before being retried
+        self._deferrals = {}  # index -> times the item was deferred
+
+    def _changed(self):
+        """Record a state change and wake event listeners. Caller holds cond."""
+        self.version += 1
+        self.cond.notify_all()
+
+    def wait_for_change(self, version, timeout):
+        """Block until the job changes past version or timeout expires; returns the current version."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def snapshot(self):
+        """Return a JSON-serialisable view of the job.
+
+        bytes_total sums the sizes reported so far, and bytes_total_final
+        says whether every item that has not failed has reported one. Until
+        then progress counts the unsized items at the average known size,
+        so a playlist shows progress before its last item starts.
+        """
+        with self.cond:
+            done = sum(item['bytes_done'] for item in self.items)
+            live = [item for item in self.items if item['status'] != 'failed']
+            sizes = [item['bytes_total'] for item in live if item['bytes_total']]
+            total = sum(sizes) if sizes else None
+            progress = None
+            if total:
+                estimated = total + (len(live) - len(sizes)) * total / len(sizes)
+                progress = round(100 * sum(item['bytes_done'] for item in live) / estimated, 1)
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'version': self.version,
+                'bytes_done': done,
+                'bytes_total': total,
+                'bytes_total_final': len(sizes) == len(live),
+                'progress': progress,
+                'items': [dict(item) for item in self.items],
+            }
+
+
+class JobManager:
+    """Runs download jobs on a bounded worker pool.
+
+    At most max_workers items download at once across all jobs, and at
+    most per_job_concurrency of those belong to the same job, so one large
+    playlist cannot starve everyone else. Items rejected with Overloaded
+    go back in the queue after its retry_after instead of failing, up to
+    max_deferrals times; after that they fail with the last error.
+    """
+
+    def __init__(self, run_item, max_workers=4, per_job_concurrency=2, max_pending_jobs=100, retention=3600,
+                 max_deferrals=10):
+        self.run_item = run_item
+        self.per_job_concurrency = per_job_concurrency
+        self.max_deferrals = max_deferrals
+        self.max_pending_jobs = max_pending_jobs
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, urls, options):
+        """Queue a job for the given URLs and return it."""
+        job = Job(urls, options)
+        with self._lock:
+            self._prune()
+            pending = sum(1 for j in self._jobs.values() if j.status not in FINISHED_STATES)
+            if pending >= self.max_pending_jobs:
+                raise JobQueueFull(f"{pending} jobs are already queued")
+            self._jobs[job.id] = job
+        with job.cond:
+            self._schedule(job)
+        return job
+
+    def get(self, job_id):
+        """Return the job with this ID, or None if it is unknown or expired."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        """Forget finished jobs older than the retention period. Caller holds _lock."""
+        cutoff = time.time() - self.retention
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished < cutoff]:
+            del self._jobs[job_id]
+
+    def _schedule(self, job):
+        """Start as many of the job's items as its concurrency allows. Caller holds job.cond."""
+        while job._running < self.per_job_concurrency and (job._retry or job._next < len(job.items)):
+            if job._retry:
+                index = job._retry.pop(0)
+            else:
+                index = job._next
+                job._next += 1
+            job._running += 1
+            # Items log with the context (request ID) of whoever submitted the job
+            self._executor.submit(contextvars.copy_context().run, self._run, job, index)
+
+    def _run(self, job, index):
+        item = job.items[index]
+        with job.cond:
+            item['status'] = 'running'
+            job.status = 'running'
+            job._changed()
+
+        def progress(bytes_done, bytes_total):
+            with job.cond:
+                item['bytes_done'] = bytes_done
+                item['bytes_total'] = bytes_total
+                job._changed()
+
+        try:
+            result = self.run_item(item['url'], job.options, progress)
+            with job.cond:
+                item['status'] = 'done'
+                item['result'] = result
+        except Overloaded as e:
+            with job.cond:
+                deferrals = job._deferrals[index] = job._deferrals.get(index, 0) + 1
+                if deferrals > self.max_deferrals:
+                    item['status'] = 'failed'
+                    item['error'] = str(e)
+                else:
+                    item['status'] = 'queued'
+                    item['bytes_done'] = 0
+                    job._waiting += 1
+            if deferrals > self.max_deferrals:
+                logger.error(f"Job {job.id} item {item['url']} failed after {self.max_deferrals} deferrals: {str(e)}")
+            else:
+                logger.info(f"Job {job.id} item {item['url']} deferred for {e.retry_after}s: {str(e)}")
+                timer = threading.Timer(e.retry_after, self._requeue, (job, index))
+                timer.daemon = True
+                timer.start()
+        except Exception as e:
+            logger.error(f"Job {job.id} item {item['url']} failed: {str(e)}")
+            with job.cond:
+                item['status'] = 'failed'
+                item['error'] = str(e)
+        finally:
+            with job.cond:
+                job._running -= 1
+                self._schedule(job)
+                if job._running == 0 and job._waiting == 0 and not job._retry and job._next == len(job.items):
+                    succeeded = sum(1 for i in job.items if i['status'] == 'done')
+                    if succeeded == len(job.items):
+                        job.status = 'done'
+                    elif succeeded:
+                        job.status = 'partial'
+                    else:
+                        job.status = 'failed'
+                    job.finished = time.time()
+                job._changed()
+
+    def _requeue(self, job, index):
+        """Put a deferred item back at the front of its job's queue."""
+        with job.cond:
+            job._waiting -= 1
+            job._retry.append(index)
+            self._schedule(job)
+            job._changed()
+
+    def stats(self):
+        """Return job counts by status and the number of items waiting to start."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        by_status = {}
+        queued_items = 0
+        for job in jobs:
+            with job.cond:
+                by_status[job.status] = by_status.get(job.status, 0) + 1
+                queued_items += sum(1 for item in job.items if item['status'] == 'queued')
+        return {'jobs': by_status, 'queued_items': queued_items}
@@ -0,0 +1,177 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be admitted now; retry_after is a hint in whole seconds."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class UpstreamBackoff:
+    """Adaptive backoff shared by every limiter that talks to YouTube.
+
+    A throttling signal (HTTP 429 or a bot check) halves the capacity of
+    every attached limiter and refuses new work for a cooldown that
+    doubles while signals keep arriving. Capacity then comes back one
+    step per quiet recovery_interval, so the whole process slows down
+    instead of each request retrying on its own.
+    """
+
+    def __init__(self, base_delay=5, max_delay=300, recovery_interval=30, recovery_step=0.1, min_scale=0.1):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.recovery_interval = recovery_interval
+        self.recovery_step = recovery_step
+        self.min_scale = min_scale
+        self._scale = 1.0
+        self._delay = 0
+        self._until = 0
+        self._last_change = 0
+        self._lock = threading.Lock()
+        self.events = 0
+
+    def throttled(self, reason):
+        """Record a throttling signal from upstream."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._until:
+                # Requests that were already in flight; one burst counts once
+                return
+            self._delay = min(self.max_delay, self._delay * 2 if self._delay else self.base_delay)
+            self._until = now + self._delay
+            self._scale = max(self.min_scale, self._scale / 2)
+            self._last_change = now
+            self.events += 1
+            delay, scale = self._delay, self._scale
+        logger.warning(f"Upstream throttled ({reason}); pausing {delay}s and reducing capacity to {scale:.0%}")
+
+    def _recover(self, now):
+        """Restore capacity for each quiet interval since the last change. Caller holds _lock."""
+        if self._scale >= 1.0 or now < self._until:
+            return
+        steps = int((now - self._last_change) // self.recovery_interval)
+        if steps:
+            self._scale = min(1.0, self._scale + steps * self.recovery_step)
+            self._last_change += steps * self.recovery_interval
+            if self._scale >= 1.0:
+                self._delay = 0
+
+    def scale(self):
+        """Return the fraction of normal capacity currently allowed."""
+        with self._lock:
+            self._recover(time.monotonic())
+            return self._scale
+
+    def cooldown(self):
+        """Return the seconds left before new work may start, or 0."""
+        with self._lock:
+            return max(0, self._until - time.monotonic())
+
+    def stats(self):
+        """Return the current scale, cooldown and number of throttling events."""
+        with self._lock:
+            now = time.monotonic()
+            self._recover(now)
+            return {
+                'scale': round(self._scale, 2),
+                'cooldown': round(max(0, self._until - now), 1),
+                'events': self.events,
+            }
+
+
+class AdmissionLimiter:
+    """Bounds how many operations of one kind run at once.
+
+    Callers over the limit wait in a queue of at most max_queue for up to
+    queue_timeout seconds. A full queue or an expired wait raises
+    Overloaded straight away, so bursts get a quick 503 instead of piling
+    up threads. With a backoff attached, the limit shrinks while upstream
+    is throttling us and nothing is admitted during its cooldown.
+    """
+
+    def __init__(self, name, limit, max_queue=0, queue_timeout=10, retry_after=5, backoff=None):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.backoff = backoff
+        self._active = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self.admitted = 0
+        self.rejected = 0
+
+    def effective_limit(self):
+        """Return the limit after any upstream backoff."""
+        if self.backoff is None:
+            return self.limit
+        return max(1, int(self.limit * self.backoff.scale()))
+
+    def _reject(self, message, retry_after):
+        """Count a rejection and raise Overloaded. Caller holds _cond."""
+        self.rejected += 1
+        raise Overloaded(message, retry_after)
+
+    def acquire(self):
+        """Take a slot, waiting in the queue if needed; raises Overloaded if none frees up in time."""
+        cooldown = self.backoff.cooldown() if self.backoff else 0
+        with self._cond:
+            if cooldown:
+                self._reject("YouTube is rate limiting requests", cooldown)
+            if self._active < self.effective_limit() and not self._waiting:
+                self._active += 1
+                self.admitted += 1
+                return
+            if self._waiting >= self.max_queue:
+                self._reject(f"Too many {self.name} requests are waiting", self.retry_after)
+
+            deadline = time.monotonic() + self.queue_timeout
+            self._waiting += 1
+            try:
+                while self._active >= self.effective_limit():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(f"Timed out waiting for a {self.name} slot", self.retry_after)
+                    # Wake periodically as well, since backoff recovery raises the limit silently
+                    self._cond.wait(min(remaining, 1.0))
+            finally:
+                self._waiting -= 1
+            self._active += 1
+            self.admitted += 1
+
+    def release(self):
+        """Give a slot back and wake one waiter."""
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self):
+        """Hold a slot for the duration of a with block."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        """Return active, queued and limit figures along with admission counters."""
+        with self._cond:
+            return {
+                'active': self._active,
+                'queued': self._waiting,
+                'limit': self.limit,
+                'effective_limit': self.effective_limit(),
+                'max_queue': self.max_queue,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+            }
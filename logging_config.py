@@ -0,0 +1,207 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Fields carried by every record logged while handling a request
+CONTEXT_FIELDS = ('request_id', 'video_id', 'format_id')
+_context = {name: contextvars.ContextVar(name, default=None) for name in CONTEXT_FIELDS}
+
+
+def bind_log_context(**fields):
+    """Attach request_id, video_id and/or format_id to records logged from the current context."""
+    for name, value in fields.items():
+        _context[name].set(value)
+
+
+def clear_log_context():
+    """Forget all context fields, e.g. at the start of a new request on a reused thread."""
+    for var in _context.values():
+        var.set(None)
+
+
+class ContextFilter(logging.Filter):
+    """Copies the context fields onto each record in the thread that logged it."""
+
+    def filter(self, record):
+        for name, var in _context.items():
+            setattr(record, name, var.get())
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most burst warnings or errors per call site through each interval.
+
+    A wave of identical upstream failures would otherwise write one line
+    (and often a traceback) per request. The number of records dropped is
+    attached to the next one let through from the same call site.
+    """
+
+    def __init__(self, burst=10, interval=60):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}  # call site -> [window start, count, suppressed]
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            self.suppressed += 1
+            return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the caller and defers traceback formatting.
+
+    The stock prepare() formats exceptions in the logging thread; here the
+    record keeps its exc_info and the listener formats it. When the queue
+    is full records are dropped and counted rather than waited on.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the context fields and any traceback."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for name in CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if getattr(record, 'suppressed', None):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The usual console format, noting suppressed repeats."""
+
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, 'suppressed', None):
+            text += f" ({record.suppressed} similar messages suppressed)"
+        return text
+
+
+class LogPipeline:
+    """The queue, listener and filters installed by setup_logging()."""
+
+    def __init__(self, queue_handler, listener, rate_limit):
+        self.queue_handler = queue_handler
+        self.listener = listener
+        self.rate_limit = rate_limit
+        self._stopped = False
+
+    def stop(self):
+        """Flush queued records and stop the writer thread."""
+        if not self._stopped:
+            self._stopped = True
+            self.listener.stop()
+
+    def stats(self):
+        """Return queue depth and how many records were dropped or suppressed."""
+        return {
+            'queued': self.queue_handler.queue.qsize(),
+            'dropped': self.queue_handler.dropped,
+            'suppressed': self.rate_limit.suppressed,
+        }
+
+
+def setup_logging(level=logging.INFO, log_file='app.log', max_bytes=10 * 1024 * 1024, backup_count=5,
+                  rotate_when=None, rotate=True, queue_size=10000, error_burst=10, error_interval=60,
+                  json_stdout=False):
+    """Route all logging through a queue to a background writer thread.
+
+    The file gets JSON lines and is rotated by size, or by time if
+    rotate_when (e.g. 'midnight') is given. With rotate=False, for several
+    processes sharing the file, it is only appended to and reopened after
+    an external rotation. No file is written if log_file is empty. stdout
+    keeps the plain text format unless json_stdout is set.
+    """
+    handlers = []
+    if not log_file:
+        file_handler = None
+    elif not rotate:
+        file_handler = logging.handlers.WatchedFileHandler(log_file, encoding='utf-8', delay=True)
+    elif rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            log_file, when=rotate_when, backupCount=backup_count, encoding='utf-8', delay=True
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True
+        )
+    if file_handler:
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if json_stdout else TextFormatter(TEXT_FORMAT))
+    handlers.append(stream_handler)
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    rate_limit = RateLimitFilter(error_burst, error_interval)
+    queue_handler.addFilter(rate_limit)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(
+        queue_handler.queue, *handlers, respect_handler_level=True
+    )
+    listener.start()
+    pipeline = LogPipeline(queue_handler, listener, rate_limit)
+    atexit.register(pipeline.stop)
+    return pipeline
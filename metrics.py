@@ -0,0 +1,243 @@
+import bisect
+import functools
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from a fast cache hit up to a long download
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _Metric:
+    """Base for a named metric family with a fixed set of label names."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        """Return the metric in the Prometheus text exposition format."""
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """A value that only goes up, such as requests by outcome."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}' for key, v in values]
+
+
+class Gauge(_Metric):
+    """A value read from a callback at scrape time.
+
+    The callback returns a number, or for labelled gauges a dict mapping
+    label value tuples to numbers, so existing stats() methods can be
+    exposed without keeping a second copy of their state.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, func, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.func = func
+
+    def _samples(self):
+        values = self.func()
+        if not self.labelnames:
+            values = {(): values}
+        return [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}'
+            for key, v in sorted(values.items())
+        ]
+
+
+class _Timer:
+    """Times a block or a function into a histogram."""
+
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(self.histogram, self.labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label key -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """Return a timer usable as a context manager or decorator.
+
+            with extract_seconds.time():
+                ...
+
+            @stage_seconds.time(stage='plan')
+            def plan_download(...):
+        """
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        lines = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """Holds metric families and renders them for /metrics."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, func, labelnames=()):
+        return self._register(Gauge(name, help, func, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+class StreamMeter:
+    """Iterator wrapper that times a streamed body.
+
+    Time blocked in next() is spent waiting on upstream (or ffmpeg); time
+    between handing a chunk out and being asked for the next one is spent
+    writing to the client, so slow clients show up as backpressure rather
+    than as a slow upstream. Everything is recorded once, when the stream
+    is exhausted or closed.
+    """
+
+    def __init__(self, chunks, on_finish):
+        self.chunks = iter(chunks)
+        self.on_finish = on_finish
+        self.bytes = 0
+        self.upstream_seconds = 0.0
+        self.client_seconds = 0.0
+        self.started = time.perf_counter()
+        self._handed_out = None
+        self.duration = None
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        now = time.perf_counter()
+        if self._handed_out is not None:
+            self.client_seconds += now - self._handed_out
+        try:
+            chunk = next(self.chunks)
+        except BaseException:
+            # Exhausted or failed; either way the stream is over
+            self.close()
+            raise
+        self._handed_out = time.perf_counter()
+        self.upstream_seconds += self._handed_out - now
+        self.bytes += len(chunk)
+        return chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._handed_out is not None:
+            self.client_seconds += time.perf_counter() - self._handed_out
+            self._handed_out = None
+        self.duration = time.perf_counter() - self.started
+        close = getattr(self.chunks, 'close', None)
+        if close:
+            close()
+        self.on_finish(self)
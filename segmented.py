@@ -0,0 +1,168 @@
+import contextvars
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import urllib3
+
+# Failures worth retrying a single segment for, rather than failing the transfer
+RETRYABLE_ERRORS = (requests.RequestException, urllib3.exceptions.HTTPError, OSError)
+
+
+class SegmentError(Exception):
+    """Raised when a byte range could not be fetched from upstream."""
+
+
+class SegmentThrottled(SegmentError):
+    """Raised when upstream answers a segment with 429; retrying would only make it worse."""
+
+
+def parse_content_range(value):
+    """Return (start, end, total) from a Content-Range header, or None."""
+    match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', value or '')
+    if not match:
+        return None
+    start, end, total = match.groups()
+    return int(start), int(end), None if total == '*' else int(total)
+
+
+class SegmentedFetcher:
+    """Fetch a large upstream file as concurrent byte ranges, yielding it in order.
+
+    Upstream throttles each connection, so splitting a transfer across
+    several ranged requests multiplies throughput. Segments that finish
+    early wait in a bounded reorder buffer until the client has consumed
+    everything before them, and a segment that falls below min_throughput
+    bytes per second (after slow_grace seconds) is re-requested from where
+    it stopped rather than holding that buffer up.
+    """
+
+    def __init__(self, transport, segment_size=8 * 1024 * 1024, concurrency=4,
+                 max_buffer_bytes=32 * 1024 * 1024, max_retries=3, retry_delay=0.5,
+                 min_throughput=128 * 1024, slow_grace=5.0):
+        self.transport = transport
+        self.segment_size = segment_size
+        self.concurrency = concurrency
+        self.max_buffer_bytes = max_buffer_bytes
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.min_throughput = min_throughput
+        self.slow_grace = slow_grace
+
+    @property
+    def window(self):
+        """Number of segments that may be in flight or buffered at once."""
+        return max(1, self.max_buffer_bytes // self.segment_size)
+
+    def deadline(self, response, size):
+        """Cut off response if its size bytes have not arrived within the minimum throughput.
+
+        Returns the started timer, which the caller cancels once the body
+        is read, or None when no minimum throughput is set.
+        """
+        if not self.min_throughput:
+            return None
+        timer = threading.Timer(self.slow_grace + size / self.min_throughput, self.abandon, (response,))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    @staticmethod
+    def abandon(response):
+        """Shut down a response's connection so a read blocked on it fails at once."""
+        sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def fetch_range(self, url, headers, start, end):
+        """Fetch bytes start..end inclusive, resuming from where a failed attempt stopped.
+
+        Returns the body as the list of chunks it arrived in. An attempt
+        slower than min_throughput is abandoned and the rest of the range
+        requested again; the last attempt is left to finish however slowly.
+        """
+        chunks = []
+        received = 0
+        attempt = 0
+        while True:
+            pos = start + received
+            try:
+                response = self.transport.get(url, headers={**(headers or {}), 'Range': f'bytes={pos}-{end}'})
+                if response.status_code == 429:
+                    response.close()
+                    raise SegmentThrottled(f"Upstream throttled bytes {pos}-{end}")
+                if response.status_code != 206:
+                    response.close()
+                    raise SegmentError(f"Expected 206 for bytes {pos}-{end}, got {response.status_code}")
+                timer = self.deadline(response, end - pos + 1) if attempt < self.max_retries else None
+                try:
+                    for chunk in self.transport.iter_chunks(response):
+                        chunks.append(chunk)
+                        received += len(chunk)
+                finally:
+                    if timer:
+                        timer.cancel()
+                if received != end - start + 1:
+                    raise SegmentError(f"Short read for bytes {start}-{end}: got {received} bytes")
+                return chunks
+            except SegmentThrottled:
+                raise
+            except (SegmentError,) + RETRYABLE_ERRORS as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise SegmentError(f"Giving up on bytes {start}-{end} after {attempt} attempts: {e}") from e
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+    def iter_range(self, url, headers, start, end, first_response=None):
+        """Yield bytes start..end inclusive in order, fetching segments concurrently.
+
+        If first_response is given it must be an open 206 response for the
+        first segment; it is streamed straight through so the client gets
+        its first bytes without waiting for a whole segment.
+        """
+        segments = [
+            (seg_start, min(seg_start + self.segment_size - 1, end))
+            for seg_start in range(start, end + 1, self.segment_size)
+        ]
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='segment')
+        pending = {}
+        next_submit = 1 if first_response is not None else 0
+
+        def schedule(next_yield):
+            nonlocal next_submit
+            while next_submit < len(segments) and next_submit - next_yield < self.window:
+                seg_start, seg_end = segments[next_submit]
+                pending[next_submit] = executor.submit(
+                    contextvars.copy_context().run, self.fetch_range, url, headers, seg_start, seg_end
+                )
+                next_submit += 1
+
+        try:
+            first = 0
+            if first_response is not None:
+                schedule(0)
+                seg_start, seg_end = segments[0]
+                received = 0
+                try:
+                    for chunk in self.transport.iter_chunks(first_response):
+                        received += len(chunk)
+                        yield chunk
+                except RETRYABLE_ERRORS:
+                    pass
+                if received < seg_end - seg_start + 1:
+                    yield from self.fetch_range(url, headers, seg_start + received, seg_end)
+                first = 1
+
+            for index in range(first, len(segments)):
+                schedule(index)
+                yield from pending.pop(index).result()
+        finally:
+            for future in pending.values():
+                future.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
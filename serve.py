@@ -0,0 +1,92 @@
+"""Production entry point for ByteLoader.
+
+    python serve.py
+
+SERVER_MODE selects the server:
+
+- ``wsgi`` (default): gunicorn with threaded workers. Each streaming
+  download holds one thread, so WEB_THREADS bounds concurrent streams
+  per worker.
+- ``asgi``: uvicorn running asgi.application, where /preview and
+  /download stream upstream bytes without holding a thread per client.
+- ``dev``: the Flask development server.
+"""
+import os
+
+HOST = os.environ.get('HOST', 'localhost')
+PORT = int(os.environ.get('PORT', 5000))
+DEBUG = os.environ.get('DEBUG', 'False').lower() in ('1', 'true', 'yes')
+SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi')
+
+# Caches, jobs and download handles live in each worker process, so one
+# worker with many threads is the default.
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 1))
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 64))
+WEB_TIMEOUT = int(os.environ.get('WEB_TIMEOUT', 120))
+WEB_KEEPALIVE = int(os.environ.get('WEB_KEEPALIVE', 5))
+
+
+def run_wsgi():
+    """Serve app.app with gunicorn's threaded workers."""
+    from gunicorn.app.base import BaseApplication
+
+    class GunicornApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from app import app
+            return app
+
+    GunicornApplication({
+        'bind': f'{HOST}:{PORT}',
+        'workers': WEB_WORKERS,
+        'worker_class': 'gthread',
+        'threads': WEB_THREADS,
+        # gthread workers heartbeat from their main loop, so long-running
+        # streams do not trip this timeout
+        'timeout': WEB_TIMEOUT,
+        'graceful_timeout': 30,
+        'keepalive': WEB_KEEPALIVE,
+        'loglevel': 'debug' if DEBUG else 'info',
+        'accesslog': '-',
+    }).run()
+
+
+def run_asgi():
+    """Serve asgi.application with uvicorn."""
+    import uvicorn
+
+    uvicorn.run(
+        'asgi:application',
+        host=HOST,
+        port=PORT,
+        workers=WEB_WORKERS,
+        timeout_keep_alive=WEB_KEEPALIVE,
+        log_level='debug' if DEBUG else 'info',
+        reload=DEBUG
+    )
+
+
+def run_dev():
+    """Serve with the Flask development server."""
+    from app import app
+
+    app.run(host=HOST, port=PORT, debug=DEBUG, threaded=True)
+
+
+SERVERS = {
+    'wsgi': run_wsgi,
+    'asgi': run_asgi,
+    'dev': run_dev,
+}
+
+if __name__ == '__main__':
+    if SERVER_MODE not in SERVERS:
+        raise SystemExit(f"Unknown SERVER_MODE {SERVER_MODE!r}; expected one of {', '.join(SERVERS)}")
+    SERVERS[SERVER_MODE]()
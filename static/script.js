@@ -14,6 +14,9 @@ document.addEventListener('DOMContentLoaded', function() {
     const progress = document.getElementById('progress');
     const convertBtn = document.querySelector('.convert-btn');
 
+    // Handle returned by /preview so /download can skip a second extraction
+    let previewHandle = null;
+
     // Hide video preview initially
     videoPreview.classList.remove('show');
 
@@ -105,6 +108,8 @@ document.addEventListener('DOMContentLoaded', function() {
                 throw new Error(data.message || 'Error loading video information');
             }
 
+            previewHandle = data.handle || null;
+
             // Update video information
             showStatus('📥 Loading video preview... Almost done!', 'info');
             updateProgress(80);
@@ -211,7 +216,7 @@ document.addEventListener('DOMContentLoaded', function() {
             // Add Video Only formats
             if (videoOnly.length > 0) {
                 const videoOnlyGroup = document.createElement('optgroup');
-                videoOnlyGroup.label = '🎬 Video Only';
+                videoOnlyGroup.label = '🎬 High Quality (audio merged)';
                 
                 // Sort video formats by quality
                 videoOnly.sort((a, b) => {
@@ -362,65 +367,47 @@ document.addEventListener('DOMContentLoaded', function() {
             // Disable download button and show loading state
             downloadBtn.disabled = true;
             downloadBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Downloading...';
-            
+
             showStatus('⏳ Preparing download... Please wait', 'info');
             progressContainer.classList.remove('hidden');
-            updateProgress(10);
+            updateProgress(0);
 
-            const response = await fetch('/download', {
+            // The server downloads in the background and reports real progress
+            const response = await fetch('/jobs', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ 
+                body: JSON.stringify({
                     url: url,
                     format_id: formatId,
-                    extract_audio: isAudioOnly
+                    extract_audio: isAudioOnly,
+                    handle: previewHandle
                 })
             });
 
-            if (!response.ok) {
-                const errorData = await response.json();
-                throw new Error(errorData.message || 'Download failed');
+            const data = await response.json();
+            if (!response.ok || !data.success) {
+                throw new Error(data.message || 'Download failed');
             }
 
-            showStatus('📥 Downloading... This may take a while', 'info');
-            updateProgress(50);
-
-            // Get the blob from the response
-            const blob = await response.blob();
-            
-            if (blob.size === 0) {
-                throw new Error('Downloaded file is empty');
+            const job = await followJob(data.job_id);
+            const item = job.items[0];
+            if (job.status !== 'done' || !item.result) {
+                throw new Error(item.error || 'Download failed');
             }
 
-            showStatus('⚙️ Processing file... Almost done!', 'info');
-            updateProgress(80);
-
-            // Create a download link
-            const downloadUrl = window.URL.createObjectURL(blob);
+            // Hand the finished file to the browser; /get_file supports resuming
             const a = document.createElement('a');
-            a.href = downloadUrl;
-            
-            // Get filename from response headers or use default
-            const contentDisposition = response.headers.get('content-disposition');
-            let filename = isAudioOnly ? 'audio.mp3' : 'video.mp4';
-            if (contentDisposition) {
-                const filenameMatch = contentDisposition.match(/filename="(.+)"/);
-                if (filenameMatch) {
-                    filename = filenameMatch[1];
-                }
-            }
-            
-            a.download = filename;
+            a.href = item.result.file_url;
+            a.download = item.result.download_name;
             document.body.appendChild(a);
             a.click();
             document.body.removeChild(a);
-            window.URL.revokeObjectURL(downloadUrl);
 
             updateProgress(100);
             showStatus('✅ Download completed successfully!', 'success');
-            
+
             // Hide progress bar after success
             setTimeout(() => {
                 progressContainer.classList.add('hidden');
@@ -437,6 +424,36 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
+    // Follow a download job over Server-Sent Events until it finishes
+    function followJob(jobId) {
+        return new Promise((resolve, reject) => {
+            const events = new EventSource(`/jobs/${jobId}/events`);
+
+            events.onmessage = function(event) {
+                const job = JSON.parse(event.data);
+
+                if (job.progress !== null) {
+                    updateProgress(job.progress);
+                }
+                if (job.progress !== null && job.bytes_total_final) {
+                    showStatus(`📥 Downloading... ${formatFileSize(job.bytes_done)} of ${formatFileSize(job.bytes_total)}`, 'info');
+                } else if (job.bytes_done) {
+                    showStatus(`📥 Downloading... ${formatFileSize(job.bytes_done)}`, 'info');
+                }
+
+                if (['done', 'failed', 'partial'].includes(job.status)) {
+                    events.close();
+                    resolve(job);
+                }
+            };
+
+            events.onerror = function() {
+                events.close();
+                reject(new Error('Lost connection to the server while downloading'));
+            };
+        });
+    }
+
     // Smooth scroll for anchor links
     document.querySelectorAll('a[href^="#"]').forEach(anchor => {
         anchor.addEventListener('click', function(e) {
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, 'bench')]
+
+# Importing app creates its folders and log file; keep them out of the tree
+_scratch = tempfile.mkdtemp(prefix='byteloader-tests-')
+os.environ.setdefault('DOWNLOAD_FOLDER', os.path.join(_scratch, 'downloads'))
+os.environ.setdefault('THUMBNAIL_FOLDER', os.path.join(_scratch, 'thumbnails'))
+os.environ.setdefault('LOG_FILE', '')
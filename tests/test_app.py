@@ -0,0 +1,30 @@
+import pytest
+
+import app
+from fake_extractor import canned_info
+
+MiB = 1024 * 1024
+
+
+@pytest.fixture
+def info():
+    return canned_info('http://upstream.test', 'abcdefghijk', 10 * MiB)
+
+
+@pytest.mark.parametrize('format_id, extract_audio, expected', [
+    ('best', False, ('18', None)),
+    ('136', False, ('136', '140')),
+    ('18', False, ('18', None)),
+    ('<=720p', False, ('136', '140')),
+    ('<=720p, vp9>h264, opus', False, ('136', '251')),
+    ('137', True, ('251', None)),
+    ('best', True, ('251', None)),
+])
+def test_select_formats(info, format_id, extract_audio, expected):
+    fmt, audio = app.select_formats(info, format_id, extract_audio)
+    assert (fmt['format_id'], audio and audio['format_id']) == expected
+
+
+def test_select_formats_unknown_id(info):
+    with pytest.raises(Exception, match='Could not find suitable format'):
+        app.select_formats(info, '999')
@@ -0,0 +1,126 @@
+import threading
+import time
+
+import pytest
+
+import cache as cache_module
+from cache import MetadataCache
+
+CALLERS = 8
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, 'monotonic', clock)
+    return clock
+
+
+def run_concurrently(cache, loader):
+    """Call get_or_load for the same key from CALLERS threads at once."""
+    results = [None] * CALLERS
+
+    def call(i):
+        try:
+            results[i] = cache.get_or_load('key', loader)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(CALLERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def blocking_loader(cache, result):
+    """Return a loader that stays in flight until every other caller is waiting on it."""
+    calls = []
+
+    def loader():
+        calls.append(1)
+        deadline = time.monotonic() + 5
+        while cache.stats()['coalesced'] < CALLERS - 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return loader, calls
+
+
+def test_concurrent_callers_share_one_load():
+    cache = MetadataCache()
+    loader, calls = blocking_loader(cache, {'id': 'abc'})
+    results = run_concurrently(cache, loader)
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert results[0] == {'id': 'abc'}
+    stats = cache.stats()
+    assert stats['misses'] == 1
+    assert stats['coalesced'] == CALLERS - 1
+    assert stats['inflight'] == 0
+    assert cache.get_or_load('key', lambda: pytest.fail('loaded again')) is results[0]
+
+
+def test_failed_load_reaches_every_waiter_and_is_not_cached():
+    cache = MetadataCache()
+    error = RuntimeError('Video unavailable')
+    loader, calls = blocking_loader(cache, error)
+    results = run_concurrently(cache, loader)
+
+    assert len(calls) == 1
+    assert all(result is error for result in results)
+    assert cache.get_or_load('key', lambda: 'retried') == 'retried'
+
+
+def test_ttl_from_loaded_value(clock):
+    cache = MetadataCache(default_ttl=300)
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return {'n': len(loads)}
+
+    ttl = lambda value: 10
+    assert cache.get_or_load('key', loader, ttl)['n'] == 1
+    clock.now += 9
+    assert cache.get_or_load('key', loader, ttl)['n'] == 1
+    clock.now += 1
+    assert cache.peek('key') is None
+    assert cache.get_or_load('key', loader, ttl)['n'] == 2
+
+
+def test_non_positive_ttl_is_not_stored(clock):
+    cache = MetadataCache()
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return {'n': len(loads)}
+
+    cache.get_or_load('key', loader, lambda value: 0)
+    cache.get_or_load('key', loader, lambda value: 0)
+    assert len(loads) == 2
+    assert cache.stats()['size'] == 0
+
+
+def test_evicts_least_recently_used(clock):
+    cache = MetadataCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.peek('a') == 1
+    assert cache.peek('b') is None
+    assert cache.stats()['evictions'] == 1
@@ -0,0 +1,115 @@
+import os
+import threading
+
+import pytest
+
+from content_cache import PART_SUFFIX, ContentCache, ContentCacheError
+
+CHUNKS = [bytes([n]) * 1000 for n in range(10)]
+DATA = b''.join(CHUNKS)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ContentCache(str(tmp_path), max_bytes=100 * 1000)
+
+
+def part_files(cache):
+    return [name for name in os.listdir(cache.folder) if name.endswith(PART_SUFFIX)]
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_tee_promotes_complete_fill(cache):
+    assert b''.join(cache.tee('a.mp4', iter(CHUNKS), expected_size=len(DATA))) == DATA
+    assert read(cache.lookup('a.mp4')) == DATA
+    assert not part_files(cache)
+
+
+def test_follower_gets_whole_file_after_writer_disconnects(cache):
+    release = threading.Event()
+
+    def upstream():
+        yield CHUNKS[0]
+        # The rest only arrives once the first client has gone
+        release.wait(5)
+        yield from CHUNKS[1:]
+
+    writer = cache.tee('a.mp4', upstream(), expected_size=len(DATA))
+    assert next(writer) == CHUNKS[0]
+    follower = cache.follow(cache.pending('a.mp4'))
+    writer.close()
+    release.set()
+
+    assert b''.join(follower) == DATA
+    assert read(cache.lookup('a.mp4')) == DATA
+
+
+def test_writer_disconnect_without_followers_abandons_fill(cache):
+    closed = []
+
+    def upstream():
+        try:
+            yield from CHUNKS
+        finally:
+            closed.append(True)
+
+    writer = cache.tee('a.mp4', upstream(), expected_size=len(DATA))
+    next(writer)
+    writer.close()
+    assert closed == [True]
+    assert cache.lookup('a.mp4') is None
+    assert not part_files(cache)
+
+
+def test_size_mismatch_aborts_and_fails_followers(cache):
+    writer = cache.tee('a.mp4', iter(CHUNKS), expected_size=len(DATA) + 1)
+    next(writer)
+    follower = cache.follow(cache.pending('a.mp4'))
+    # The writer's own client still gets every byte upstream sent
+    assert len(b''.join(writer)) == len(DATA) - len(CHUNKS[0])
+    with pytest.raises(ContentCacheError):
+        b''.join(follower)
+    assert cache.lookup('a.mp4') is None
+    assert not part_files(cache)
+
+
+def test_upstream_error_fails_followers(cache):
+    def upstream():
+        yield CHUNKS[0]
+        raise OSError('connection reset')
+
+    writer = cache.tee('a.mp4', upstream())
+    next(writer)
+    follower = cache.follow(cache.pending('a.mp4'))
+    with pytest.raises(OSError):
+        next(writer)
+    with pytest.raises(ContentCacheError):
+        b''.join(follower)
+    assert not part_files(cache)
+
+
+def test_write_error_keeps_streaming_uncached(cache, monkeypatch):
+    def append(fill, chunk):
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(cache, 'append', append)
+    assert b''.join(cache.tee('a.mp4', iter(CHUNKS), expected_size=len(DATA))) == DATA
+    assert cache.lookup('a.mp4') is None
+    assert cache.pending('a.mp4') is None
+    assert not part_files(cache)
+
+
+def test_quota_counts_fills_in_progress(cache):
+    assert cache.begin('huge.mp4', cache.max_bytes + 1) is None
+    first = cache.begin('a.mp4', 60 * 1000)
+    assert first is not None
+    assert cache.begin('b.mp4', 60 * 1000) is None
+    cache.append(first, b'x' * 60 * 1000)
+    cache.finish('a.mp4', first)
+    # Room for the new fill is made by evicting the finished file first
+    assert cache.begin('b.mp4', 60 * 1000) is not None
+    assert cache.lookup('a.mp4') is None
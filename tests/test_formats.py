@@ -0,0 +1,96 @@
+import pytest
+
+from fake_extractor import canned_info
+from formats import VIDEO_CODECS, FormatIndex, FormatSpecError, Preference, parse_preference
+
+MiB = 1024 * 1024
+
+
+def make_info(*extra_formats):
+    """Canned extraction with 10 MiB videos and 1 MiB audio, plus any extra formats."""
+    info = canned_info('http://upstream.test', 'abcdefghijk', 10 * MiB)
+    info['formats'] += [
+        {'protocol': 'https', 'url': f'http://upstream.test/{f["format_id"]}', **f} for f in extra_formats
+    ]
+    return info
+
+
+VP9_720 = {'format_id': '247', 'ext': 'webm', 'vcodec': 'vp9', 'acodec': 'none', 'filesize': 8 * MiB, 'height': 720}
+
+
+@pytest.mark.parametrize('spec, expected', [
+    ('<=1080p, av1>vp9>h264, smallest', Preference(max_height=1080, codecs=('av1', 'vp9', 'h264'))),
+    ('720p', Preference(max_height=720)),
+    ('≤480p, largest', Preference(max_height=480, order='largest')),
+    ('webm>mp4', Preference(containers=('webm', 'mp4'))),
+    ('prefer vp9', Preference(codecs=('vp9',))),
+    ('<=500MB', Preference(max_size=500 * MiB)),
+    ('<=1.5GiB', Preference(max_size=int(1.5 * 1024 ** 3))),
+    ('progressive, mp4', Preference(progressive=True, containers=('mp4',))),
+    ('Audio, OPUS>AAC', Preference(audio_only=True, codecs=('opus', 'aac'))),
+])
+def test_parse_preference(spec, expected):
+    assert parse_preference(spec) == expected
+
+
+@pytest.mark.parametrize('spec', ['', ' , ', '137', 'best quality', 'h264>webm', '<=500', '<=lots'])
+def test_parse_preference_rejects(spec):
+    with pytest.raises(FormatSpecError):
+        parse_preference(spec)
+
+
+def test_best_pair_takes_highest_resolution_with_mux_audio():
+    video, audio = FormatIndex.of(make_info()).best_pair(Preference(codecs=VIDEO_CODECS))
+    assert (video['format_id'], audio['format_id']) == ('137', '140')
+
+
+def test_best_pair_honours_height_cap():
+    video, audio = FormatIndex.of(make_info()).best_pair(Preference(max_height=720))
+    assert (video['format_id'], audio['format_id']) == ('136', '140')
+
+
+def test_best_pair_progressive_has_no_audio():
+    video, audio = FormatIndex.of(make_info()).best_pair(Preference(progressive=True))
+    assert (video['format_id'], audio) == ('18', None)
+
+
+def test_best_pair_follows_codec_order():
+    index = FormatIndex.of(make_info(VP9_720))
+    assert index.best_pair(Preference(max_height=720, codecs=('vp9', 'h264')))[0]['format_id'] == '247'
+    assert index.best_pair(Preference(max_height=720, codecs=('h264', 'vp9')))[0]['format_id'] == '136'
+
+
+def test_best_pair_breaks_ties_on_size():
+    index = FormatIndex.of(make_info(VP9_720))
+    assert index.best_pair(Preference(max_height=720))[0]['format_id'] == '247'
+    assert index.best_pair(Preference(max_height=720, order='largest'))[0]['format_id'] == '136'
+
+
+def test_best_pair_picks_mux_audio_from_spec_codecs():
+    index = FormatIndex.of(make_info(VP9_720))
+    assert index.best_pair(Preference(max_height=720, codecs=('vp9', 'opus')))[1]['format_id'] == '251'
+    # Vorbis cannot be muxed into MP4, so AAC is used instead
+    assert index.best_pair(Preference(max_height=720, codecs=('vp9', 'vorbis')))[1]['format_id'] == '140'
+
+
+def test_size_cap_counts_muxed_audio():
+    index = FormatIndex.of(make_info())
+    # 1080p is 21 MiB with audio, 720p is 11 MiB
+    assert index.best_pair(Preference(max_size=15 * MiB))[0]['format_id'] == '136'
+    # 720p no longer fits once its audio is counted, but the progressive 360p does
+    assert index.best_pair(Preference(max_size=10 * MiB))[0]['format_id'] == '18'
+    assert index.best_pair(Preference(max_size=MiB)) == (None, None)
+
+
+def test_audio_choice_prefers_bitrate_then_spec():
+    index = FormatIndex.of(make_info())
+    assert index.select(Preference(audio_only=True))['format_id'] == '251'
+    assert index.select(Preference(audio_only=True, codecs=('aac',)))['format_id'] == '140'
+    assert index.select(Preference(audio_only=True, containers=('m4a',)))['format_id'] == '140'
+    assert index.select(Preference(audio_only=True, max_size=MiB // 2)) is None
+
+
+def test_mux_audio():
+    index = FormatIndex.of(make_info())
+    assert index.mux_audio()['format_id'] == '140'
+    assert index.mux_audio(('opus',))['format_id'] == '251'
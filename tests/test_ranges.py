@@ -0,0 +1,21 @@
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, None),
+    ('bytes=0-99', (0, 99)),
+    ('bytes=100-', (100, None)),
+    ('bytes=-500', (500, 999)),
+    ('bytes=-5000', (0, 999)),
+    ('bytes=0-1,5-6', None),
+    ('items=0-1', None),
+    ('bytes=abc', None),
+])
+def test_parse_byte_range(header, expected):
+    assert app.parse_byte_range(header, {'filesize': 1000}) == expected
+
+
+def test_parse_byte_range_suffix_needs_size():
+    assert app.parse_byte_range('bytes=-500', {}) is None
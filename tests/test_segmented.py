@@ -0,0 +1,73 @@
+import pytest
+
+from fake_upstream import FakeUpstream, synthetic_bytes
+from segmented import SegmentedFetcher, SegmentError, SegmentThrottled
+from transport import UpstreamTransport
+
+KiB = 1024
+SIZE = 1000 * KiB + 123  # not a multiple of the segment size
+
+
+@pytest.fixture
+def upstream(request):
+    server = FakeUpstream(**getattr(request, 'param', {})).start()
+    yield server
+    server.stop()
+
+
+def fetcher(**kwargs):
+    options = {'segment_size': 64 * KiB, 'concurrency': 4, 'max_buffer_bytes': 256 * KiB, 'retry_delay': 0.01}
+    return SegmentedFetcher(UpstreamTransport(), **{**options, **kwargs})
+
+
+def expected(start, end):
+    return b''.join(synthetic_bytes(start, end))
+
+
+@pytest.mark.parametrize('upstream', [{'truncate_rate': 0.3, 'seed': 1}], indirect=True)
+@pytest.mark.parametrize('start, end', [(0, SIZE - 1), (100, 700 * KiB), (SIZE - 10, SIZE - 1)])
+def test_iter_range_is_byte_exact_despite_truncation(upstream, start, end):
+    url = upstream.url_for('abcdefghijk', '18', SIZE)
+    assert b''.join(fetcher(max_retries=10).iter_range(url, None, start, end)) == expected(start, end)
+    if end - start > 64 * KiB:
+        assert upstream.stats['truncated']
+
+
+@pytest.mark.parametrize('upstream', [{'truncate_rate': 0.3, 'seed': 2}], indirect=True)
+def test_iter_range_streams_first_response(upstream):
+    url = upstream.url_for('abcdefghijk', '18', SIZE)
+    segments = fetcher(max_retries=10)
+    first = segments.transport.get(url, headers={'Range': f'bytes=0-{64 * KiB - 1}'})
+    assert b''.join(segments.iter_range(url, None, 0, SIZE - 1, first_response=first)) == expected(0, SIZE - 1)
+
+
+@pytest.mark.parametrize('upstream', [{'truncate_rate': 1.0}], indirect=True)
+def test_fetch_range_resumes_short_reads(upstream):
+    url = upstream.url_for('abcdefghijk', '18', SIZE)
+    with pytest.raises(SegmentError):
+        fetcher(max_retries=3).fetch_range(url, None, 0, SIZE - 1)
+    assert upstream.stats['requests'] == 4
+    # Every body is cut in half. Starting over each time would send half
+    # the range four times; resuming only asks for what is still missing.
+    assert upstream.stats['bytes'] < 1.5 * SIZE
+
+
+@pytest.mark.parametrize('upstream', [{'connection_bandwidth': 256 * KiB}], indirect=True)
+def test_fetch_range_abandons_slow_attempts(upstream):
+    url = upstream.url_for('abcdefghijk', '18', SIZE)
+    slow = fetcher(min_throughput=1024 * KiB, slow_grace=0.2, max_retries=2)
+    assert b''.join(slow.fetch_range(url, None, 0, 256 * KiB - 1)) == expected(0, 256 * KiB - 1)
+    # Two attempts are cut off at their deadline; the last one may take as long as it needs
+    assert upstream.stats['requests'] == 3
+
+
+@pytest.mark.parametrize('upstream', [{'throttle_rate': 1.0}], indirect=True)
+def test_fetch_range_does_not_retry_throttled(upstream):
+    url = upstream.url_for('abcdefghijk', '18', SIZE)
+    throttled = []
+    segments = fetcher()
+    segments.transport.on_throttle = throttled.append
+    with pytest.raises(SegmentThrottled):
+        segments.fetch_range(url, None, 0, 64 * KiB - 1)
+    assert upstream.stats['requests'] == 1
+    assert len(throttled) == 1
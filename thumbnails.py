@@ -0,0 +1,189 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from cache import MetadataCache
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it thumbnails are served at their original size
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SUFFIX = '.thumb'
+MAX_THUMBNAIL_BYTES = 4 * 1024 * 1024
+
+# Leading bytes of the image types YouTube serves thumbnails in
+_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF8', 'image/gif'),
+)
+
+
+class ThumbnailError(Exception):
+    """Raised when a thumbnail could not be fetched from upstream."""
+
+
+def sniff_content_type(data):
+    """Return the MIME type of image bytes, or None if they are not a known image."""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in _SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    return None
+
+
+class Thumbnail:
+    """Image bytes along with their content type and a strong ETag."""
+
+    __slots__ = ('data', 'content_type', 'etag')
+
+    def __init__(self, data, content_type):
+        self.data = data
+        self.content_type = content_type
+        self.etag = hashlib.sha256(data).hexdigest()[:32]
+
+
+class ThumbnailCache:
+    """Video thumbnails cached in memory in front of a bounded directory on disk.
+
+    A thumbnail is fetched from upstream once, shrunk to width pixels if
+    Pillow is installed, and written to disk. Recently used thumbnails are
+    also kept in memory. Concurrent requests for one video share a fetch.
+    """
+
+    def __init__(self, folder, transport, width=480, quality=85, max_age=86400,
+                 memory_entries=256, max_bytes=256 * 1024 * 1024):
+        self.folder = folder
+        self.transport = transport
+        self.width = width if Image is not None else 0
+        self.quality = quality
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.memory = MetadataCache(max_entries=memory_entries, default_ttl=max_age)
+        self._index = OrderedDict()  # filename -> size, least recently used first
+        self._lock = threading.Lock()
+        self.fetches = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        os.makedirs(folder, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """Index thumbnails already on disk, oldest first."""
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.name.endswith(THUMBNAIL_SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+
+    def filename(self, video_id):
+        """Return the disk cache file name for a video at the configured width."""
+        return f"{video_id}-{self.width or 'orig'}{THUMBNAIL_SUFFIX}"
+
+    def get(self, video_id, source_url):
+        """Return the Thumbnail for video_id, fetching it from source_url on a miss."""
+        return self.memory.get_or_load(video_id, lambda: self._load(video_id, source_url))
+
+    def _load(self, video_id, source_url):
+        """Read the thumbnail from disk if it is fresh, otherwise fetch and store it."""
+        name = self.filename(video_id)
+        path = os.path.join(self.folder, name)
+        try:
+            if time.time() - os.path.getmtime(path) < self.max_age:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                content_type = sniff_content_type(data)
+                if content_type:
+                    with self._lock:
+                        self.disk_hits += 1
+                        if name in self._index:
+                            self._index.move_to_end(name)
+                    return Thumbnail(data, content_type)
+        except FileNotFoundError:
+            pass
+
+        data = self._resize(self._fetch(source_url))
+        self._store(name, path, data)
+        return Thumbnail(data, sniff_content_type(data))
+
+    def _fetch(self, url):
+        """Download a thumbnail, refusing anything that is not a reasonably sized image."""
+        response = self.transport.request('GET', url, stream=True)
+        try:
+            if response.status_code != 200:
+                raise ThumbnailError(f"Upstream returned {response.status_code} for thumbnail")
+            data = response.raw.read(MAX_THUMBNAIL_BYTES + 1, decode_content=True)
+        finally:
+            response.close()
+        with self._lock:
+            self.fetches += 1
+        if len(data) > MAX_THUMBNAIL_BYTES or not sniff_content_type(data):
+            raise ThumbnailError("Upstream thumbnail is not a usable image")
+        return data
+
+    def _resize(self, data):
+        """Shrink the image to the configured width as a JPEG, or return it unchanged."""
+        if not self.width:
+            return data
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                if image.width <= self.width:
+                    return data
+                height = max(1, round(image.height * self.width / image.width))
+                resized = image.convert('RGB').resize((self.width, height), Image.LANCZOS)
+            out = io.BytesIO()
+            resized.save(out, 'JPEG', quality=self.quality, optimize=True, progressive=True)
+            return out.getvalue()
+        except Exception as e:
+            logger.warning(f"Could not resize thumbnail: {str(e)}")
+            return data
+
+    def _store(self, name, path, data):
+        """Write a thumbnail to disk atomically and evict old ones over the quota."""
+        part_path = f"{path}.{threading.get_ident()}.part"
+        try:
+            with open(part_path, 'wb') as f:
+                f.write(data)
+            os.replace(part_path, path)
+        except OSError as e:
+            logger.warning(f"Could not cache thumbnail {name}: {str(e)}")
+            return
+        evicted = []
+        with self._lock:
+            self._index[name] = len(data)
+            self._index.move_to_end(name)
+            total = sum(self._index.values())
+            while total > self.max_bytes and len(self._index) > 1:
+                old_name, size = self._index.popitem(last=False)
+                total -= size
+                evicted.append(old_name)
+            self.evictions += len(evicted)
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.folder, old_name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Return memory and disk counters."""
+        with self._lock:
+            disk = {
+                'files': len(self._index),
+                'bytes': sum(self._index.values()),
+                'max_bytes': self.max_bytes,
+                'fetches': self.fetches,
+                'disk_hits': self.disk_hits,
+                'evictions': self.evictions,
+                'resize_width': self.width or None,
+            }
+        return {'memory': self.memory.stats(), 'disk': disk}
@@ -0,0 +1,201 @@
+import logging
+import os
+import threading
+
+import ffmpeg
+
+from limits import AdmissionLimiter, Overloaded
+
+logger = logging.getLogger(__name__)
+
+# Output settings for each audio extraction target
+AUDIO_FORMATS = {
+    'mp3': {'format': 'mp3', 'acodec': 'libmp3lame', 'ext': 'mp3', 'mimetype': 'audio/mpeg'},
+    'opus': {'format': 'ogg', 'acodec': 'libopus', 'ext': 'opus', 'mimetype': 'audio/ogg'},
+}
+
+# Fragmented MP4 can be written to a pipe because it needs no seek back
+# to patch the moov atom once the stream ends.
+FRAGMENTED_MP4_FLAGS = 'frag_keyframe+empty_moov+default_base_moof'
+
+
+class TranscodeBusy(Overloaded):
+    """Raised when every ffmpeg worker slot is taken."""
+
+
+class TranscodeError(Exception):
+    """Raised when ffmpeg exits with an error."""
+
+
+# ffmpeg's messages when a URL it fetches itself answers 429. Builds
+# before 7.1 have no message of their own for 429 and report every 4xx
+# other than 400, 401, 403 and 404 as the generic one below.
+THROTTLE_MARKERS = ('Too Many Requests', '4XX Client Error')
+
+
+class _ProcessStream:
+    """Iterator over an ffmpeg process's stdout that cleans up after itself.
+
+    It is a class rather than a generator so that close() kills the
+    process and frees its worker slot even if iteration never started.
+    """
+
+    def __init__(self, process, release, chunk_size, feed=None, on_throttle=None):
+        self.process = process
+        self.release = release
+        self.chunk_size = chunk_size
+        self.on_throttle = on_throttle
+        self.stderr_tail = b''
+        self.closed = False
+        threading.Thread(target=self._drain_stderr, daemon=True).start()
+        if feed is not None:
+            threading.Thread(target=self._feed, args=(feed,), daemon=True).start()
+
+    def _feed(self, chunks):
+        """Copy upstream bytes into ffmpeg's stdin."""
+        try:
+            for chunk in chunks:
+                self.process.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            # ffmpeg exited or the stream was closed
+            pass
+        except Exception as e:
+            logger.error(f"Upstream feed to ffmpeg failed: {str(e)}")
+            self.process.kill()
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close:
+                close()
+            try:
+                self.process.stdin.close()
+            except (BrokenPipeError, ValueError):
+                pass
+
+    def _drain_stderr(self):
+        """Keep the last few KB of stderr for error messages without blocking ffmpeg."""
+        for line in iter(self.process.stderr.readline, b''):
+            self.stderr_tail = (self.stderr_tail + line)[-4096:]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        chunk = os.read(self.process.stdout.fileno(), self.chunk_size)
+        if chunk:
+            return chunk
+        returncode = self.process.wait()
+        self.close()
+        if returncode != 0:
+            message = self.stderr_tail.decode('utf-8', 'replace').strip().splitlines()
+            message = message[-1] if message else 'no output'
+            if self.on_throttle and any(marker in message for marker in THROTTLE_MARKERS):
+                self.on_throttle(message)
+            raise TranscodeError(f"ffmpeg exited with {returncode}: {message}")
+        raise StopIteration
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.release()
+
+
+class FFmpegPipeline:
+    """Runs a bounded number of ffmpeg processes that stream through pipes.
+
+    Nothing is written to disk: input arrives on stdin or is read by
+    ffmpeg from the direct URLs, and output is read from stdout chunk by
+    chunk as it is produced. When ffmpeg reads a URL itself, a 429 from
+    it is passed to on_throttle(message), if given.
+    """
+
+    def __init__(self, max_workers=4, queue_timeout=10, chunk_size=64 * 1024, ffmpeg_cmd='ffmpeg', max_queue=16,
+                 on_throttle=None):
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.ffmpeg_cmd = ffmpeg_cmd
+        self.on_throttle = on_throttle
+        self._slots = AdmissionLimiter('ffmpeg', max_workers, max_queue=max_queue, queue_timeout=queue_timeout)
+
+    def _acquire(self):
+        try:
+            self._slots.acquire()
+        except Overloaded as e:
+            raise TranscodeBusy("All transcoding workers are busy", e.retry_after) from e
+
+    def _release(self):
+        self._slots.release()
+
+    def _run(self, stream_spec, open_feed=None, on_throttle=None):
+        """Start ffmpeg once a worker slot is free.
+
+        open_feed, if given, is called only after the slot is taken and
+        returns the chunks to write to ffmpeg's stdin, so nothing upstream
+        is held open while waiting in the queue.
+        """
+        # -nostdin keeps ffmpeg from reading the server's terminal for keys
+        stream_spec = stream_spec.global_args('-nostdin')
+        self._acquire()
+        feed = None
+        try:
+            if open_feed is not None:
+                feed = open_feed()
+            process = ffmpeg.run_async(
+                stream_spec,
+                cmd=self.ffmpeg_cmd,
+                pipe_stdin=feed is not None,
+                pipe_stdout=True,
+                pipe_stderr=True
+            )
+        except BaseException:
+            self._release()
+            close = getattr(feed, 'close', None)
+            if close:
+                close()
+            raise
+        return _ProcessStream(process, self._release, self.chunk_size, feed, on_throttle)
+
+    def audio(self, open_chunks, audio_format='mp3', bitrate='192k'):
+        """Transcode upstream audio bytes, returning an iterator of encoded output.
+
+        open_chunks() is called once a worker slot is free and returns the
+        upstream bytes; the returned iterator's close() must release them.
+        """
+        target = AUDIO_FORMATS[audio_format]
+        stream_spec = (
+            ffmpeg
+            .input('pipe:0')
+            .output('pipe:1', format=target['format'], acodec=target['acodec'], audio_bitrate=bitrate, vn=None)
+            .global_args('-loglevel', 'error')
+        )
+        return self._run(stream_spec, open_feed=open_chunks)
+
+    def mux(self, video_url, audio_url, headers=None):
+        """Mux separate video and audio streams into fragmented MP4 without re-encoding."""
+        input_args = {}
+        if headers:
+            input_args['headers'] = ''.join(f'{key}: {value}\r\n' for key, value in headers.items())
+        video = ffmpeg.input(video_url, **input_args)
+        audio = ffmpeg.input(audio_url, **input_args)
+        stream_spec = (
+            ffmpeg
+            .output(video.video, audio.audio, 'pipe:1', format='mp4', c='copy', movflags=FRAGMENTED_MP4_FLAGS)
+            .global_args('-loglevel', 'error')
+        )
+        return self._run(stream_spec, on_throttle=self.on_throttle)
+
+    def stats(self):
+        """Return active, queued and maximum worker counts."""
+        slots = self._slots.stats()
+        return {
+            'active': slots['active'],
+            'queued': slots['queued'],
+            'max_workers': self.max_workers,
+            'rejected': slots['rejected'],
+        }
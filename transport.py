@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Reads that fill the buffer faster than this grow the next read size,
+# reads slower than ADAPT_SLOW shrink it so slow upstreams still trickle out.
+ADAPT_FAST = 0.05
+ADAPT_SLOW = 0.5
+
+
+class _HostStats:
+    """Counters for a single upstream host."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.streaming = 0
+        self.bytes = 0
+
+
+class UpstreamTransport:
+    """Thread-safe, connection-pooled HTTP client shared by all requests.
+
+    One keep-alive session holds a connection pool per upstream host, so
+    TCP and TLS handshakes are paid once per pooled connection rather than
+    once per download. googlevideo spreads media over many edge hosts, so
+    only the max_hosts most recently used pools (and their counters) are
+    kept; older pools are closed along with their idle sockets.
+    on_throttle(host), if given, is called for every 429 reply.
+    """
+
+    def __init__(self, pool_size=32, connect_timeout=5, read_timeout=30,
+                 min_chunk_size=64 * 1024, max_chunk_size=1024 * 1024, on_throttle=None, max_hosts=16):
+        self.pool_size = pool_size
+        self.max_hosts = max_hosts
+        self.on_throttle = on_throttle
+        self.timeout = (connect_timeout, read_timeout)
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max(min_chunk_size, max_chunk_size)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=pool_size, max_retries=0)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._stats = OrderedDict()  # host -> _HostStats, least recently used first
+        self._lock = threading.Lock()
+
+    def _host_stats(self, host):
+        """Return the counters for host, forgetting the least recently used host beyond max_hosts."""
+        with self._lock:
+            stats = self._stats.get(host)
+            if stats is None:
+                stats = self._stats[host] = _HostStats()
+                while len(self._stats) > self.max_hosts:
+                    self._stats.popitem(last=False)
+            else:
+                self._stats.move_to_end(host)
+            return stats
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the pool for the URL's host."""
+        host = urlparse(url).netloc
+        stats = self._host_stats(host)
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = self._session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                stats.requests += 1
+                stats.errors += 1
+            raise
+        with self._lock:
+            stats.requests += 1
+            if response.status_code >= 400:
+                stats.errors += 1
+        if response.status_code == 429 and self.on_throttle:
+            self.on_throttle(host)
+        # Redirects may change response.url, so remember whose counters it belongs to
+        response.upstream_stats = stats
+        return response
+
+    def get(self, url, **kwargs):
+        """Open a streaming GET request."""
+        kwargs.setdefault('stream', True)
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        """Send a HEAD request, following redirects."""
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('HEAD', url, **kwargs)
+
+    def iter_chunks(self, response):
+        """Yield the response body using adaptively sized reads, then close it."""
+        stats = getattr(response, 'upstream_stats', None)
+        size = self.min_chunk_size
+        if stats is not None:
+            with self._lock:
+                stats.streaming += 1
+        try:
+            while True:
+                started = time.monotonic()
+                chunk = response.raw.read(size, decode_content=True)
+                if not chunk:
+                    break
+                elapsed = time.monotonic() - started
+                if stats is not None:
+                    with self._lock:
+                        stats.bytes += len(chunk)
+                yield chunk
+
+                if len(chunk) == size and elapsed < ADAPT_FAST and size < self.max_chunk_size:
+                    size = min(size * 2, self.max_chunk_size)
+                elif elapsed > ADAPT_SLOW and size > self.min_chunk_size:
+                    size = max(size // 2, self.min_chunk_size)
+        finally:
+            response.close()
+            if stats is not None:
+                with self._lock:
+                    stats.streaming -= 1
+
+    def stats(self):
+        """Return request, error, byte and connection pool counters per recently used host."""
+        pools = self._session.get_adapter('https://').poolmanager.pools
+        opened = {}
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                opened[key.key_host] = opened.get(key.key_host, 0) + pool.num_connections
+        with self._lock:
+            hosts = {}
+            for host, stats in self._stats.items():
+                hosts[host] = {
+                    'requests': stats.requests,
+                    'errors': stats.errors,
+                    'streaming': stats.streaming,
+                    'bytes': stats.bytes,
+                    'connections_opened': opened.get(urlparse(f'//{host}').hostname, 0),
+                    'pool_size': self.pool_size,
+                }
+            return hosts